@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = False  # Set to True to answer near-duplicate search_web questions from earlier answers
+ANSWER_CACHE_EMBED_MODEL = "nomic-embed-text"  # Adjust to an embedding model available in Ollama
+ANSWER_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity between two questions to reuse an answer
+ANSWER_CACHE_TTL = 60 * 60  # Seconds an answer stays fresh, search results go stale quickly
+ANSWER_CACHE_MAX_ENTRIES = 2000  # Least recently used answers are evicted beyond this
+ANSWER_CACHE_DB_PATH = "./answer_cache.db"  # Set to None to keep the cache in memory only
+
+class AnswerCache:
+    """
+    Semantic cache of search_web answers.
+
+    Questions are embedded through the embedding cache and compared with the questions
+    answered before by cosine similarity, as one matrix product over the normalized vectors.
+    An answer is reused when the best match is above the threshold, was produced by the same
+    chat model and is younger than the TTL.
+    """
+
+    def __init__(self, embedding_cache, ollama_client, enabled=ANSWER_CACHE_ENABLED,
+                 embed_model=ANSWER_CACHE_EMBED_MODEL, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES, db_path=ANSWER_CACHE_DB_PATH):
+        self.embedding_cache = embedding_cache
+        self.ollama_client = ollama_client
+        self.enabled = enabled
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # key -> {"model", "query", "answer", "created_at", "used_at"}
+        self.vectors = {}  # key -> normalized question vector
+        self._keys = []
+        self._matrix = None  # Rows of self._keys, rebuilt after the entries change
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db_path = db_path
+        self._db = None  # Opened by open(), at startup
+        self._db_lock = threading.Lock()
+
+    def open(self):
+        """Open the database and load the fresh answers. Blocking, called from a worker thread at startup."""
+        if self.enabled and self.db_path and self._db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, embed_model TEXT NOT NULL, model TEXT NOT NULL, "
+                "query TEXT NOT NULL, vector BLOB NOT NULL, answer TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+            self._load()
+
+    def _load(self):
+        import numpy as np
+        expiry = time.time() - self.ttl
+        rows = self._db.execute(
+            "SELECT key, model, query, vector, answer, created_at FROM answers WHERE embed_model = ? AND created_at > ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            (self.embed_model, expiry, self.max_entries),
+        ).fetchall()
+        for key, model, query, blob, answer, created_at in rows:
+            self.entries[key] = {"model": model, "query": query, "answer": json.loads(answer),
+                                 "created_at": created_at, "used_at": created_at}
+            self.vectors[key] = np.frombuffer(blob, dtype=np.float32)
+        self._matrix = None
+        logger.info(f"Answer cache loaded {len(rows)} answers")
+
+    def _index(self):
+        import numpy as np
+        if self._matrix is None:
+            self._keys = list(self.vectors)
+            self._matrix = np.stack([self.vectors[key] for key in self._keys]) if self._keys else None
+        return self._matrix
+
+    def _delete(self, keys):
+        with self._db_lock:
+            self._db.executemany("DELETE FROM answers WHERE key = ?", [(key,) for key in keys])
+            self._db.commit()
+
+    async def _remove(self, keys):
+        for key in keys:
+            self.entries.pop(key, None)
+            self.vectors.pop(key, None)
+        self._matrix = None
+        if self._db is not None and keys:
+            await asyncio.to_thread(self._delete, keys)
+
+    async def _expire(self):
+        expiry = time.time() - self.ttl
+        expired = [key for key, entry in self.entries.items() if entry["created_at"] <= expiry]
+        overflow = len(self.entries) - len(expired) - self.max_entries
+        if overflow > 0:
+            alive = sorted((entry["used_at"], key) for key, entry in self.entries.items() if entry["created_at"] > expiry)
+            expired += [key for _, key in alive[:overflow]]
+            self.evictions += overflow
+        if expired:
+            await self._remove(expired)
+
+    async def embed(self, query):
+        """The normalized embedding of a question."""
+        import numpy as np
+        response = await self.embedding_cache.embed(
+            self.ollama_client, {"model": self.embed_model, "input": [query], "truncate": True}
+        )
+        if "embeddings" not in response:
+            raise ValueError(response.get("error", "No embedding returned"))
+        vector = np.asarray(response["embeddings"][0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def lookup(self, query, model):
+        """
+        Return (vector, answer) for a question. answer is None on a miss, vector is then
+        passed to store() once the answer is generated.
+        """
+        import numpy as np
+        vector = await self.embed(query)
+        await self._expire()
+        matrix = self._index()
+        if matrix is not None and matrix.shape[1] == vector.shape[0]:
+            scores = matrix @ vector
+            # Best match among the answers of the same chat model
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.threshold:
+                    break
+                entry = self.entries[self._keys[index]]
+                if entry["model"] == model:
+                    entry["used_at"] = time.time()
+                    self.hits += 1
+                    logger.debug(f"Answer cache hit ({scores[index]:.3f}): {query!r} ~ {entry['query']!r}")
+                    return vector, entry["answer"]
+        self.misses += 1
+        return vector, None
+
+    async def store(self, vector, query, model, answer):
+        key = uuid.uuid4().hex
+        now = time.time()
+        self.entries[key] = {"model": model, "query": query, "answer": answer, "created_at": now, "used_at": now}
+        self.vectors[key] = vector
+        self._matrix = None
+        await self._expire()
+        if self._db is not None:
+            await asyncio.to_thread(self._persist, key, model, query, vector, answer, now)
+
+    def _persist(self, key, model, query, vector, answer, created_at):
+        import numpy as np
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (key, embed_model, model, query, vector, answer, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, self.embed_model, model, query, vector.astype(np.float32).tobytes(), json.dumps(answer), created_at),
+            )
+            self._db.commit()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "threshold": self.threshold,
+        }
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from sqlalchemy import or_
+from app.database import SessionLocal, ChatHistory, ChatMessage
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_SIZE = 256  # Recent sessions kept in memory
+CHAT_CONTEXT_WINDOW = 40  # Maximum number of non-system messages sent to Ollama, None for no limit
+CHAT_CONTEXT_MAX_CHARS = 32000  # Maximum size of the context sent to Ollama, oldest messages are dropped first
+
+def context_message(message):
+    """The part of a stored message or Ollama response that is sent back to Ollama."""
+    if isinstance(message.get("message"), dict):
+        message = message["message"]
+    return {key: value for key, value in message.items() if key in ("role", "content", "images", "tool_calls")}
+
+def apply_window(messages, window=CHAT_CONTEXT_WINDOW, max_chars=CHAT_CONTEXT_MAX_CHARS):
+    """Keep the system messages and the most recent other messages that fit the window."""
+    system = [message for message in messages if message.get("role") == "system"]
+    others = [message for message in messages if message.get("role") != "system"]
+    if window is not None:
+        others = others[-window:] if window > 0 else []
+    if max_chars is not None:
+        budget = max_chars - sum(len(message.get("content") or "") for message in system)
+        kept = []
+        for message in reversed(others):
+            budget -= len(message.get("content") or "")
+            if budget < 0 and kept:
+                break
+            kept.append(message)
+        others = kept[::-1]
+    return system + others
+
+class ChatSessionStore:
+    """
+    Conversation context of /api/chat sessions.
+
+    Recent sessions are kept in memory, already windowed, so a new turn only appends the new
+    messages. Sessions that are not cached are loaded from chat_messages, reading only the
+    system messages and the last messages of the window.
+    """
+
+    def __init__(self, writer=None, size=SESSION_CACHE_SIZE, window=CHAT_CONTEXT_WINDOW, max_chars=CHAT_CONTEXT_MAX_CHARS):
+        self.writer = writer  # ChatHistoryWriter flushed before reading, so the session's queued messages are not missed
+        self.size = size
+        self.window = window
+        self.max_chars = max_chars
+        self.sessions = OrderedDict()
+
+    def _cache(self, session_id, messages):
+        self.sessions[session_id] = messages
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.size:
+            self.sessions.popitem(last=False)
+
+    def _read(self, session_id):
+        db = SessionLocal()
+        try:
+            if db.query(ChatHistory.id).filter(ChatHistory.session_id == session_id).first() is None:
+                return None
+            query = db.query(ChatMessage.message).filter(ChatMessage.session_id == session_id)
+            system = query.filter(ChatMessage.role == "system").order_by(ChatMessage.seq).all()
+            recent = query.filter(or_(ChatMessage.role.is_(None), ChatMessage.role != "system")).order_by(ChatMessage.seq.desc())
+            if self.window is not None:
+                recent = recent.limit(self.window)
+            rows = system + recent.all()[::-1]
+            return [context_message(row.message) for row in rows if row.message]
+        finally:
+            db.close()
+
+    async def load(self, session_id):
+        """Return the context of a session, or None when the session does not exist."""
+        messages = self.sessions.get(session_id)
+        if messages is not None:
+            self.sessions.move_to_end(session_id)
+            return messages
+        if self.writer is not None:
+            # Only this session's queued messages matter, not the whole write queue
+            await self.writer.flush(session_id)
+        messages = await asyncio.to_thread(self._read, session_id)
+        if messages is not None:
+            self._cache(session_id, messages)
+            logger.debug(f"Session {session_id} loaded with {len(messages)} messages")
+        return messages
+
+    def update(self, session_id, context, messages):
+        """Set the context of a session to `context` followed by `messages`, and return it windowed."""
+        context = apply_window(context + [context_message(message) for message in messages], self.window, self.max_chars)
+        self._cache(session_id, context)
+        return context
+
+    def extend(self, session_id, messages):
+        """
+        Append messages to a cached session and return its windowed context.
+        A session evicted meanwhile is left out, its next turn reloads it from chat_messages.
+        """
+        context = self.sessions.get(session_id)
+        if context is None:
+            return None
+        return self.update(session_id, context, messages)
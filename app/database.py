@@ -1,23 +1,61 @@
-from sqlalchemy import create_engine, Column, Integer, String, JSON
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-
-SQLALCHEMY_DATABASE_URL = "sqlite:///./chat_history.db"
-
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-class ChatHistory(Base):
-    __tablename__ = "chat_history"
-
-    id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String, index=True)
-    messages = Column(JSON)
-
-Base.metadata.create_all(bind=engine)
-
-def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, Text, DateTime, JSON, Index
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./chat_history.db"
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets readers work while the history writer commits
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base = declarative_base()
+
+class ChatHistory(Base):
+    """One row per chat session, the messages themselves live in chat_messages."""
+    __tablename__ = "chat_history"
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String, index=True)
+    messages = Column(JSON)  # Legacy: whole conversations stored before chat_messages existed
+    model = Column(String, index=True)
+    created_at = Column(DateTime, index=True)
+    updated_at = Column(DateTime)
+    message_count = Column(Integer, default=0)
+
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String, nullable=False)
+    seq = Column(Integer, nullable=False)
+    role = Column(String)
+    content = Column(Text)
+    message = Column(JSON)  # The message as sent by the client or returned by Ollama
+    created_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_chat_messages_session_seq", "session_id", "seq", unique=True),
+    )
+
+def _add_missing_columns():
+    # create_all does not alter existing tables, add the columns introduced after the first release
+    columns = {column["name"] for column in inspect(engine).get_columns(ChatHistory.__tablename__)}
+    with engine.begin() as connection:
+        for column in ChatHistory.__table__.columns:
+            if column.name not in columns:
+                connection.execute(text(f"ALTER TABLE {ChatHistory.__tablename__} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+        for index in ChatHistory.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+def init_db():
+    Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
\ No newline at end of file
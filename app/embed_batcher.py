@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from app.singleflight import payload_key
+from app.metrics import EMBED_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_WINDOW = 0.005  # Seconds to wait for more requests for the same model before calling Ollama
+EMBED_BATCH_MAX_INPUTS = 64  # A batch is sent as soon as it holds this many inputs
+
+class EmbeddingBatcher:
+    """
+    Merge concurrent embedding requests into one Ollama call.
+
+    Requests for the same model and options arriving within the batch window are sent as a
+    single /api/embed call, the vectors are then handed back to every caller in order.
+    A text requested several times in a batch is embedded once.
+    Exposes generate_embeddings() like OllamaClient, so it can be used in its place.
+    """
+
+    def __init__(self, ollama_client, window=EMBED_BATCH_WINDOW, max_inputs=EMBED_BATCH_MAX_INPUTS):
+        self.ollama_client = ollama_client
+        self.window = window
+        self.max_inputs = max_inputs
+        self.pending = {}  # batch key -> {"payload", "texts", "index": {text: position}, "requests": [(positions, future)], "timer"}
+        self.running = set()  # Tasks sending a batch, referenced until done so they are not garbage collected
+        self.requests = 0
+        self.batches = 0
+        self.inputs = 0
+        self.largest = 0
+
+    async def generate_embeddings(self, payload):
+        inputs = payload.get("input")
+        if not inputs:
+            return await self.ollama_client.generate_embeddings(payload)
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if len(inputs) >= self.max_inputs:
+            # Already a full batch, nothing to gain from waiting
+            return await self._send({**payload, "input": inputs}, 1)
+
+        key = payload_key({name: value for name, value in payload.items() if name != "input"})
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = {"payload": payload, "texts": [], "index": {}, "requests": [], "timer": None}
+            batch["timer"] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        positions = []
+        for text in inputs:
+            if text not in batch["index"]:
+                batch["index"][text] = len(batch["texts"])
+                batch["texts"].append(text)
+            positions.append(batch["index"][text])
+        future = asyncio.get_running_loop().create_future()
+        batch["requests"].append((positions, future))
+        if len(batch["texts"]) >= self.max_inputs:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        task = asyncio.create_task(self._run(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _send(self, payload, requests):
+        self.requests += requests
+        self.batches += 1
+        self.inputs += len(payload["input"])
+        self.largest = max(self.largest, len(payload["input"]))
+        EMBED_BATCH_SIZE.observe(len(payload["input"]))
+        return await self.ollama_client.generate_embeddings(payload)
+
+    async def _run(self, batch):
+        requests = batch["requests"]
+        combined = batch["texts"]
+        try:
+            response = await self._send({**batch["payload"], "input": combined}, len(requests))
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        embeddings = response.get("embeddings")
+        if embeddings is None or len(embeddings) != len(combined):
+            # Ollama error, every caller gets the error response
+            for _, future in requests:
+                if not future.done():
+                    future.set_result(response)
+            return
+        for positions, future in requests:
+            if not future.done():
+                future.set_result({**response, "embeddings": [embeddings[position] for position in positions]})
+        logger.debug(f"Embedded {len(combined)} inputs of {len(requests)} requests in one call")
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "inputs": self.inputs,
+            "mean_batch_inputs": round(self.inputs / self.batches, 2) if self.batches else 0,
+            "mean_batch_requests": round(self.requests / self.batches, 2) if self.batches else 0,
+            "largest_batch": self.largest,
+        }
@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+EMBED_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Size of the in-memory tier
+EMBED_CACHE_DB_PATH = "./embedding_cache.db"  # Persistent tier, set to None to keep the cache in memory only
+
+def embedding_key(model, truncate, text):
+    """Content address of an embedding: the model, the truncate flag and a hash of the text."""
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model}:{int(bool(truncate))}:{digest}"
+
+class EmbeddingCache:
+    """
+    Two tier cache for /api/embed results.
+
+    Vectors are kept in an in-memory LRU bounded by their size in bytes and, optionally,
+    in a SQLite table that survives restarts. Only the texts missing from both tiers are
+    sent to Ollama, duplicates inside one batch are embedded once.
+    """
+
+    def __init__(self, max_bytes=EMBED_CACHE_MAX_BYTES, db_path=EMBED_CACHE_DB_PATH):
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None  # Opened by open(), at startup
+        self._db_lock = threading.Lock()
+
+    def open(self):
+        """Open the persistent tier. Blocking, called from a worker thread at startup."""
+        if self.db_path and self._db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+
+    def _remember(self, key, vector):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = vector
+        self.size += vector.itemsize * len(vector)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.itemsize * len(evicted)
+            self.evictions += 1
+
+    def _load(self, keys):
+        with self._db_lock:
+            placeholders = ",".join("?" * len(keys))
+            rows = self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys).fetchall()
+        vectors = {}
+        for key, blob in rows:
+            vector = array("d")
+            vector.frombytes(blob)
+            vectors[key] = vector
+        return vectors
+
+    def _store(self, items):
+        now = time.time()
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                [(key, vector.tobytes(), now) for key, vector in items],
+            )
+            self._db.commit()
+
+    async def embed(self, ollama_client, payload):
+        """
+        Return the embeddings for payload["input"] in the original order, calling Ollama for the misses only.
+        """
+        model = payload["model"]
+        truncate = payload.get("truncate", True)
+        texts = payload["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        keys = [embedding_key(model, truncate, text) for text in texts]
+
+        found = {}
+        for key in dict.fromkeys(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+        self.hits += len(found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self._db is not None:
+            stored = await asyncio.to_thread(self._load, missing)
+            for key, vector in stored.items():
+                self._remember(key, vector)
+            found.update(stored)
+            self.disk_hits += len(stored)
+            missing = [key for key in missing if key not in stored]
+
+        response = {"model": model}
+        if missing:
+            self.misses += len(missing)
+            text_by_key = dict(zip(keys, texts))
+            upstream = await ollama_client.generate_embeddings(
+                {**payload, "input": [text_by_key[key] for key in missing]}
+            )
+            if "embeddings" not in upstream:
+                # Pass Ollama errors through untouched, nothing gets cached
+                return upstream
+            computed = [(key, array("d", vector)) for key, vector in zip(missing, upstream["embeddings"])]
+            for key, vector in computed:
+                self._remember(key, vector)
+                found[key] = vector
+            if self._db is not None:
+                await asyncio.to_thread(self._store, computed)
+            response.update({k: v for k, v in upstream.items() if k != "embeddings"})
+
+        response["embeddings"] = [found[key].tolist() for key in keys]
+        logger.debug(f"Embedding cache: {len(texts)} inputs, {len(missing)} sent to Ollama")
+        return response
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "persistent": self._db is not None,
+        }
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse, urljoin
+from app.metrics import record_timing, EXTRACTION_CPU_SECONDS
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_WORKERS = 2  # Processes used for HTML extraction, 0 runs it on the default thread pool instead
+
+def favicon_url(url, hrefs):
+    """Resolve the first favicon link of a page, or the common /favicon.ico path."""
+    parsed_url = urlparse(url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    for href in hrefs:
+        if href:
+            return urljoin(base_url, href)
+    return urljoin(base_url, '/favicon.ico')
+
+def extract_clean_text(html, url):
+    """Extract the visible text and the favicon of a page with BeautifulSoup."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Remove script tags and comments
+    for unwanted_elements in soup(["script", "style"]):
+        unwanted_elements.decompose()  # Remove scripts and styles etc
+
+    cleaned_html = soup.get_text(separator='\n', strip=True)
+
+    # Attempt to fetch favicon from meta tags
+    links = soup.find_all('link', rel=lambda x: x and ('favicon' in x.lower() or 'shortcut icon' in x.lower()))
+    return cleaned_html, favicon_url(url, (link.get('href') for link in links))
+
+def extract_trafilatura(html, url):
+    """Extract the main content of a page with trafilatura."""
+    import trafilatura
+    result = trafilatura.extract(html)
+    if not result:
+        raise ValueError("No content found at the URL using trafilatura.")
+    return result, None
+
+def extract_lxml(html, url):
+    """Extract the visible text and the favicon of a page with lxml, faster than BeautifulSoup on large pages."""
+    from lxml import html as lxml_html
+    tree = lxml_html.fromstring(html)
+    for element in tree.xpath('//script|//style|//noscript'):
+        element.drop_tree()
+    text = '\n'.join(part.strip() for part in tree.itertext() if part.strip())
+    hrefs = tree.xpath('//link[contains(translate(@rel, "FAVICONSHRT", "faviconshrt"), "icon")]/@href')
+    return text, favicon_url(url, hrefs)
+
+# Extraction backends by name: functions (html, url) -> (text, favicon)
+EXTRACTORS = {
+    "clean": extract_clean_text,
+    "trafilatura": extract_trafilatura,
+    "lxml": extract_lxml,
+}
+
+def register_extractor(name, func):
+    """
+    Add an extraction backend. The function must be defined at module level so that it
+    can be sent to the worker processes.
+    """
+    EXTRACTORS[name] = func
+
+def timed_extract(extractor, html, url):
+    """Run an extractor and measure the CPU time it used, in the worker process."""
+    started = time.process_time()
+    result = extractor(html, url)
+    return result, time.process_time() - started
+
+def preload_extractors():
+    """Import the extraction libraries, run in every worker process as it starts."""
+    import bs4, lxml.html, trafilatura  # noqa: F401
+
+_pool = None
+
+def start_extraction_pool(workers=EXTRACTION_WORKERS):
+    global _pool
+    if _pool is None and workers > 0:
+        # The scraping libraries are only imported in the workers, which start now and load
+        # them in the background rather than on the first page
+        _pool = ProcessPoolExecutor(max_workers=workers, initializer=preload_extractors)
+        _pool.submit(int)
+        logger.info(f"Extraction pool started with {workers} processes")
+    return _pool
+
+def stop_extraction_pool():
+    global _pool
+    if _pool is not None:
+        # Wait for the workers to exit, forked workers would otherwise outlive the server
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+        logger.info("Extraction pool stopped")
+
+async def extract_page(kind, html, url):
+    """Run an extraction backend on the worker pool and return (text, favicon)."""
+    global _pool
+    extractor = EXTRACTORS[kind]
+    pool = start_extraction_pool()
+    loop = asyncio.get_running_loop()
+    try:
+        result, cpu_seconds = await loop.run_in_executor(pool, timed_extract, extractor, html, url)
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory on a huge page), replace the pool for the next pages
+        # Only the first page to notice retires the pool, a replacement already started by
+        # another page is left alone. The broken pool is not waited for on the event loop.
+        if _pool is pool:
+            logger.error("Extraction pool broken, restarting it")
+            _pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    EXTRACTION_CPU_SECONDS.observe(cpu_seconds, backend=kind)
+    record_timing("extraction_cpu", cpu_seconds)
+    return result
@@ -1,288 +1,420 @@
-import aiohttp
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse, urljoin
-import random
-import logging
-from pydantic import BaseModel
-from fastapi import APIRouter, Request, HTTPException
-import trafilatura
-from aiohttp.client_exceptions import ClientError
-from datetime import datetime
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-SEARXNG_URL = "http://localhost:4000/search"  # Adjust this URL to your SearXng instance
-LLM_ENDPOINT = "http://localhost:11434"  # Adjust this URL to your LLM endpoint
-
-# Define a Pydantic model for input JSON
-class ScrapeRequest(BaseModel):
-    url: str
-
-class SearchQuery(BaseModel):
-    search_query: str
-
-functions_router = APIRouter()
-
-async def search_with_searxng(query, session):
-    params = {
-        'q': query,
-        'categories_general': 'general',
-        'language': 'en',
-        'format': 'json'
-    }
-    async with session.get(SEARXNG_URL, params=params) as response:
-        if response.status == 200:
-            return await response.json()
-        else:
-            raise HTTPException(status_code=500, detail="Failed to fetch results from SearXng")
-
-async def fetch_url_with_timeout(url, timeout=4):
-    loop = asyncio.get_running_loop()
-    try:
-        downloaded = await loop.run_in_executor(ThreadPoolExecutor(), trafilatura.fetch_url, url)
-        return downloaded
-    except Exception as e:
-        logger.error(f"Error fetching URL {url}: {e}")
-        return None
-
-async def scrape_trafilatura(url, max_tokens=1024, max_retries=3, retry_delay=2, session=None):
-    """
-    Scrapes the content from a URL using trafilatura and handles errors and anti-scraping measures.
-    If trafilatura fails, it falls back to BeautifulSoup for content extraction.
-
-    :param url: The URL to scrape.
-    :param max_tokens: The maximum number of tokens to return.
-    :param max_retries: The maximum number of retries in case of a request failure.
-    :param retry_delay: The delay between retries in seconds.
-    :param session: An aiohttp session to reuse.
-    :return: A string containing the truncated text.
-    """
-    attempt = 0
-    while attempt < max_retries:
-        try:
-            # Fetch the URL with a timeout
-            downloaded = await asyncio.wait_for(fetch_url_with_timeout(url), timeout=4)
-            if downloaded is None:
-                raise Exception("Timeout occurred while fetching the URL using trafilatura.")
-            
-            # Extract the content
-            result = trafilatura.extract(downloaded)
-            
-            if not result:
-                raise ValueError("No content found at the URL using trafilatura.")
-            
-            # Tokenize the extracted content using basic string operations
-            tokens = result.split()
-            
-            # Truncate the tokens to the specified number
-            truncated_tokens = tokens[:max_tokens]
-            
-            # Convert tokens back to string
-            truncated_text = ' '.join(truncated_tokens)
-            
-            return truncated_text
-        
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout occurred while fetching URL {url}. Moving to the next URL...")
-            break  # Move to the next URL
-        
-        except ClientError as e:
-            logger.error(f"Request failed: {e}. Retrying in {retry_delay} seconds...")
-            await asyncio.sleep(retry_delay)
-        
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}. Retrying in {retry_delay} seconds...")
-            await asyncio.sleep(retry_delay)
-        
-        attempt += 1
-        # Introduce a random delay between 0 and 2 seconds to mimic human behavior
-        await asyncio.sleep(random.uniform(0, 2))
-    
-    raise Exception("Failed to retrieve data after several attempts.")
-
-async def search_xng(query, session):
-    try:
-        searxng_results = await search_with_searxng(query, session)
-        results = []
-        
-        for idx, item in enumerate(searxng_results['results'][:3]):
-            url = item['url']
-            try:
-                content = await scrape_trafilatura(url, session=session)
-            except Exception as e:
-                logger.error(f"Failed to scrape URL {url}: {e}. Skipping to the next URL...")
-                continue
-            results.append({
-                "number": idx + 1,
-                "title": item['title'],
-                "url": url,
-                "content": content
-            })
-        
-        # datetime object containing current date and time
-        now = datetime.now()
-        # dd/mm/YY H:M:S
-        dateTime = now.strftime("%d/%m/%Y %H:%M:%S")
-        
-        # Prepare the prompt for the LLM
-        prompt = f"""You are a web research assistant. Answer the following question based on the provided sources denoted by <id[number]>. Always cite your sources with the <id[number]> AND <url> used from the sources. If the Question is answerable in a short sentence, do that.
-        If you have knowledge to supplement the answer, do it but don't do it if that knowledge is not current. Keep in mind that the current date and time is {dateTime}.\n\nQuestion: {query}\n\nSources:\n"""
-        for result in results:
-            prompt += f"id:[{result['number']}.] - url:{result['url']}\ncontent:{result['content']}\n\n"
-
-        return prompt
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-def random_user_agent():
-    """Generate a random user agent string."""
-    user_agents = [
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x86) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0",
-        "Mozilla/5.0 (iPhone; CPU iPhone OS 14_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) CriOS/91.0.4472.77 Mobile/15E148 Safari/604.1",
-        "Mozilla/5.0 (Linux; Android 11; Pixel 5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.77 Mobile Safari/537.36",
-        # Add more user agents as needed
-    ]
-    return random.choice(user_agents)
-
-async def scrape_clean_text(url, max_retries=3, delay=5, timeout=10, session=None):
-    """
-    Scrapes the provided URL for clean textual content and favicon, handling errors gracefully and retrying on failures.
-
-    Parameters:
-    url (str): The URL of the webpage to scrape.
-    max_retries (int): Maximum number of retries. Default is 3.
-    delay (float): Delay between retries in seconds. Default is 5 seconds.
-    timeout (float): Timeout for the request in seconds. Default is 10 seconds.
-    session (aiohttp.ClientSession): An aiohttp session to reuse.
-
-    Returns:
-    dict: A dictionary containing 'url', 'cleaned_html', and optionally 'favicon'.
-    """
-    parsed_url = urlparse(url)
-    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-    headers = {
-        'User-Agent': random_user_agent(),
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Connection': 'keep-alive',  # Optional to mimic a persistent connection
-    }
-
-    for attempt in range(max_retries + 1):
-        try:
-            if session:
-                async with session.get(url, headers=headers, timeout=timeout) as response:
-                    response.raise_for_status()  # Raise an exception for HTTP errors
-                    html = await response.text()
-            else:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers, timeout=timeout) as response:
-                        response.raise_for_status()  # Raise an exception for HTTP errors
-                        html = await response.text()
-
-            soup = BeautifulSoup(html, 'html.parser')
-
-            # Remove script tags and comments
-            for unwanted_elements in soup(["script", "style"]):
-                unwanted_elements.decompose()  # Remove scripts and styles etc
-
-            cleaned_html = soup.get_text(separator='\n', strip=True)
-
-            # Attempt to fetch favicon from meta tags
-            favicon_link = None
-            for link in soup.find_all('link', rel=lambda x: x and ('favicon' in x.lower() or 'shortcut icon' in x.lower())):
-                href = link.get('href')
-                if href:
-                    favicon_link = urljoin(base_url, href)
-                    break
-
-            # If favicon not found in meta tags, try a common favicon path
-            if not favicon_link:
-                favicon_link = urljoin(base_url, '/favicon.ico')
-
-            result = {
-                "url": url,
-                "cleaned_html": cleaned_html,
-                "favicon": favicon_link
-            }
-            return result
-
-        except ClientError as e:
-            logger.error(f"HTTP error occurred while scraping {url}: {e}")
-            raise HTTPException(status_code=e.status, detail=str(e))
-        except Exception as e:
-            logger.error(f"An error occurred while scraping {url}: {e}")
-            if attempt < max_retries:
-                delay_time = random.uniform(0.5, delay)  # Random delay between retries
-                logger.info(f"Retrying in {delay_time:.2f} seconds...")
-                await asyncio.sleep(delay_time)
-            else:
-                raise HTTPException(status_code=500, detail=str(e))
-    return None
-
-@functions_router.post('/scrape')
-async def scrape_endpoint(request: ScrapeRequest):
-    """
-    Handle POST requests to scrape URLs and return scraped data.
-    """
-    try:
-        async with aiohttp.ClientSession() as session:
-            scraped_data = await scrape_clean_text(request.url, session=session)
-        return scraped_data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
-
-@functions_router.post('/searx')
-async def searx_endpoint(input: SearchQuery):
-    try:
-        query = input.search_query
-        async with aiohttp.ClientSession() as session:
-            searxng_results = await search_with_searxng(query, session)
-            results = []
-            
-            for idx, item in enumerate(searxng_results['results'][:3]):
-                url = item['url']
-                try:
-                    content = await scrape_trafilatura(url, session=session)
-                except Exception as e:
-                    logger.error(f"Failed to scrape URL {url}: {e}. Skipping to the next URL...")
-                    continue
-                results.append({
-                    "number": idx + 1,
-                    "title": item['title'],
-                    "url": url,
-                    "content": content
-                })
-            
-            # Prepare the prompt for the LLM
-            prompt = f"""You are a web research assistant. Answer the following question based on the provided sources denoted by <id[number]>. Always cite your sources based on the provided id.\n\nQuestion: {query}\n\nSources:\n"""
-            for result in results:
-                prompt += f"id:[{result['number']}.]\ncontent:{result['content']}\n\n"
-                logger.debug("PROMPT SENT:", prompt)
-            
-            # Send the prompt to the LLM
-            llm_response = await session.post(LLM_ENDPOINT, json={"model":"gemma2:2b-instruct-q6_K","prompt": prompt,"stream":False,"options":{"num_ctx":8192}})
-            if llm_response.status == 200:
-                answer = await llm_response.json()
-                answer = answer.get("response", "No answer generated.")
-            else:
-                answer = "Failed to generate an answer from the LLM."
-            
-            return {
-                "question": query,
-                "sources": results,
-                "answer": answer
-            }
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@functions_router.get("/")
-async def function_get():
+import aiohttp
+from urllib.parse import urlparse
+import random
+import logging
+from pydantic import BaseModel
+from fastapi import APIRouter, Request, HTTPException
+from aiohttp.client_exceptions import ClientError
+from datetime import datetime
+import asyncio
+from contextlib import asynccontextmanager
+from app.http_client import get_session
+from app.page_cache import page_cache, normalize_url
+from app.singleflight import coalesce, payload_key
+from app.metrics import stage, SEARXNG_SECONDS, SCRAPE_SECONDS, SCRAPE_ERRORS
+from app.extraction import extract_page
+from app.ollama_client import ollama_client
+from app.retrieval import select_passages
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SEARXNG_URL = "http://localhost:4000/search"  # Adjust this URL to your SearXng instance
+SEARX_MODEL = "gemma2:2b-instruct-q6_K"  # Adjust to the model answering /searx questions, Ollama backends are set in app/ollama_client.py
+
+# Source scraping for web searches
+SEARCH_TOP_N = 3  # Number of search results to scrape
+SEARCH_FIRST_K = None  # Build the prompt from the first K sources that succeed, None waits for all of the top N
+SEARCH_DEADLINE = 12  # Seconds allowed for the whole search stage (SearXNG query and scraping)
+SCRAPE_CONCURRENCY = 8  # Maximum number of pages scraped at the same time
+SCRAPE_PER_HOST = 2  # Maximum number of pages scraped at the same time from a single host
+SOURCE_MAX_WORDS = 5000  # Words of a page passed to passage selection, the rest is ignored
+SEARCH_NUM_CTX = 4096  # Context window of search answers, must fit RETRIEVAL_TOKEN_BUDGET (app/retrieval.py), the instructions and the answer
+
+# Page downloads
+PAGE_MAX_BYTES = 2 * 1024 * 1024  # Only this many bytes of a page are downloaded and extracted
+PAGE_CHUNK_SIZE = 64 * 1024
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
+# Define a Pydantic model for input JSON
+class ScrapeRequest(BaseModel):
+    url: str
+    no_cache: bool = False  # Skip the page cache and fetch the page again
+
+class SearchQuery(BaseModel):
+    search_query: str
+    no_cache: bool = False
+
+functions_router = APIRouter()
+
+async def search_with_searxng(query, session, timeout=SEARCH_DEADLINE):
+    params = {
+        'q': query,
+        'categories_general': 'general',
+        'language': 'en',
+        'format': 'json'
+    }
+    try:
+        with stage(SEARXNG_SECONDS, "searxng"):
+            # Bounded by the search deadline, the shared session would otherwise wait minutes for a hung SearXNG
+            async with session.get(SEARXNG_URL, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    raise HTTPException(status_code=500, detail="Failed to fetch results from SearXng")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"SearXNG did not answer within {timeout:.1f}s")
+
+def browser_headers():
+    return {
+        'User-Agent': random_user_agent(),
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.5',
+        'Connection': 'keep-alive',  # Optional to mimic a persistent connection
+    }
+
+class UnsupportedContentType(Exception):
+    """Raised when a URL does not point to an HTML page (PDFs, images, media...)."""
+
+async def read_html(response, max_bytes=PAGE_MAX_BYTES):
+    """
+    Reads an HTML response in chunks, stopping at max_bytes.
+    Non-HTML responses are rejected from their headers, before any of the body is read.
+    """
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type and content_type not in HTML_CONTENT_TYPES:
+        raise UnsupportedContentType(f"Unsupported content type {content_type} for {response.url}")
+
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_chunked(PAGE_CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            logger.debug(f"Page {response.url} cut off at {max_bytes} bytes")
+            response.close()  # Drop the connection instead of downloading the rest
+            break
+    body = b"".join(chunks)[:max_bytes]
+    try:
+        return body.decode(response.charset or 'utf-8', errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+async def fetch_page(url, kind, session=None, timeout=10, use_cache=True, max_bytes=PAGE_MAX_BYTES):
+    """
+    Downloads and extracts a page through the page cache.
+
+    Fresh entries are served from the cache, stale ones are revalidated with a conditional GET
+    using their ETag/Last-Modified validators. With use_cache=False the cached entry is ignored
+    and replaced by the newly fetched page.
+
+    :param url: The URL to fetch.
+    :param kind: The name of the extraction backend, pages are cached per backend.
+    :param session: An aiohttp session to reuse. Defaults to the shared session.
+    :param timeout: Timeout for the request in seconds.
+    :param use_cache: Whether cached entries may be used.
+    :param max_bytes: The maximum number of bytes of the page to download.
+    :return: The cache entry with 'content' and 'favicon'.
+    """
+    entry = await page_cache.get(kind, url) if use_cache else None
+    if entry is not None and page_cache.is_fresh(entry):
+        return entry
+
+    headers = browser_headers()
+    if entry is not None:
+        if entry.get("etag"):
+            headers['If-None-Match'] = entry["etag"]
+        if entry.get("last_modified"):
+            headers['If-Modified-Since'] = entry["last_modified"]
+
+    if session is None:
+        session = get_session()
+    try:
+        with stage(SCRAPE_SECONDS, "scrape", backend=kind):
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 304 and entry is not None:
+                    return await page_cache.touch(entry)
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                html = await read_html(response, max_bytes)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+
+            content, favicon = await extract_page(kind, html, url)
+    except Exception:
+        SCRAPE_ERRORS.inc(backend=kind)
+        raise
+    return await page_cache.put(kind, url, content, favicon, etag=etag, last_modified=last_modified)
+
+def truncate_words(text, max_words):
+    """The first `max_words` words of a text, one line per non-empty line of the text."""
+    lines, count = [], 0
+    for line in text.splitlines():
+        words = line.split()[:max_words - count]
+        if words:
+            lines.append(" ".join(words))
+            count += len(words)
+        if count >= max_words:
+            break
+    return "\n".join(lines)
+
+async def scrape_trafilatura(url, max_tokens=1024, max_retries=3, retry_delay=2, session=None, use_cache=True):
+    """
+    Scrapes the content from a URL using trafilatura and handles errors and anti-scraping measures.
+    If trafilatura fails, it falls back to BeautifulSoup for content extraction.
+
+    :param url: The URL to scrape.
+    :param max_tokens: The maximum number of tokens to return.
+    :param max_retries: The maximum number of retries in case of a request failure.
+    :param retry_delay: The delay between retries in seconds.
+    :param session: An aiohttp session to reuse.
+    :param use_cache: Whether the page cache may be used.
+    :return: A string containing the truncated text.
+    """
+    attempt = 0
+    while attempt < max_retries:
+        try:
+            # Fetch the URL with a timeout and extract the content
+            page = await fetch_page(url, "trafilatura", session=session, timeout=4, use_cache=use_cache)
+            result = page["content"]
+            
+            # Truncate to the specified number of words, keeping the line breaks so passage selection sees the paragraphs
+            return truncate_words(result, max_tokens)
+        
+        except UnsupportedContentType as e:
+            logger.error(f"{e}. Moving to the next URL...")
+            break  # Retrying will not turn it into a web page
+        
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout occurred while fetching URL {url}. Moving to the next URL...")
+            break  # Move to the next URL
+        
+        except ClientError as e:
+            logger.error(f"Request failed: {e}. Retrying in {retry_delay} seconds...")
+            await asyncio.sleep(retry_delay)
+        
+        except Exception as e:
+            logger.error(f"An unexpected error occurred: {e}. Retrying in {retry_delay} seconds...")
+            await asyncio.sleep(retry_delay)
+        
+        attempt += 1
+        # Introduce a random delay between 0 and 2 seconds to mimic human behavior
+        await asyncio.sleep(random.uniform(0, 2))
+    
+    raise Exception("Failed to retrieve data after several attempts.")
+
+class ScrapeLimiter:
+    """Limits the number of concurrent scrapes, globally and per host."""
+
+    def __init__(self, limit=SCRAPE_CONCURRENCY, per_host=SCRAPE_PER_HOST):
+        self.total = asyncio.Semaphore(limit)
+        self.per_host = per_host
+        self.hosts = {}  # host -> [semaphore, number of users]
+
+    @asynccontextmanager
+    async def slot(self, url):
+        host = urlparse(url).netloc.lower()
+        entry = self.hosts.setdefault(host, [asyncio.Semaphore(self.per_host), 0])
+        entry[1] += 1
+        try:
+            # Wait for the host first so a busy host does not hold global slots
+            async with entry[0]:
+                async with self.total:
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.hosts[host]
+
+scrape_limiter = ScrapeLimiter()
+
+async def gather_sources(items, session, top_n=SEARCH_TOP_N, first_k=SEARCH_FIRST_K, deadline=SEARCH_DEADLINE, use_cache=True):
+    """
+    Scrapes the top search results concurrently.
+
+    :param items: The SearXNG results, in rank order.
+    :param session: An aiohttp session to reuse.
+    :param top_n: The number of results to scrape.
+    :param first_k: Stop as soon as this many sources were scraped, None waits for all of them.
+    :param deadline: Seconds to wait for the sources, whatever arrived in time is used.
+    :param use_cache: Whether the page cache may be used.
+    :return: The scraped sources in rank order.
+    """
+    async def scrape(idx, item):
+        async with scrape_limiter.slot(item['url']):
+            content = await scrape_trafilatura(item['url'], max_tokens=SOURCE_MAX_WORDS, session=session, use_cache=use_cache)
+        return {
+            "number": idx + 1,
+            "title": item['title'],
+            "url": item['url'],
+            "content": content
+        }
+
+    pending = {asyncio.create_task(scrape(idx, item)) for idx, item in enumerate(items[:top_n])}
+    results = []
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    try:
+        while pending:
+            remaining = end - loop.time()
+            if remaining <= 0:
+                logger.warning(f"Search deadline reached, skipping {len(pending)} unfinished sources...")
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    results.append(task.result())
+                except Exception as e:
+                    logger.error(f"Failed to scrape source: {e}. Skipping to the next URL...")
+            if first_k and len(results) >= first_k:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    results.sort(key=lambda result: result["number"])
+    return results
+
+@coalesce("search", key=lambda query, session=None, use_cache=True: payload_key(query.strip().lower(), use_cache))
+async def search_xng(query, session, use_cache=True):
+    try:
+        started = asyncio.get_running_loop().time()
+        searxng_results = await search_with_searxng(query, session, timeout=SEARCH_DEADLINE)
+        # Scraping gets what is left of the deadline
+        elapsed = asyncio.get_running_loop().time() - started
+        results = await gather_sources(searxng_results['results'], session, deadline=max(SEARCH_DEADLINE - elapsed, 0), use_cache=use_cache)
+        # Keep the passages most relevant to the question instead of the start of every page
+        results = await select_passages(query, results)
+        
+        # datetime object containing current date and time
+        now = datetime.now()
+        # dd/mm/YY H:M:S
+        dateTime = now.strftime("%d/%m/%Y %H:%M:%S")
+        
+        # Prepare the prompt for the LLM
+        prompt = f"""You are a web research assistant. Answer the following question based on the provided sources denoted by <id[number]>. Always cite your sources with the <id[number]> AND <url> used from the sources. If the Question is answerable in a short sentence, do that.
+        If you have knowledge to supplement the answer, do it but don't do it if that knowledge is not current. Keep in mind that the current date and time is {dateTime}.\n\nQuestion: {query}\n\nSources:\n"""
+        for result in results:
+            prompt += f"id:[{result['number']}.] - url:{result['url']}\ncontent:{result['content']}\n\n"
+
+        return prompt
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def random_user_agent():
+    """Generate a random user agent string."""
+    user_agents = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x86) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0",
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 14_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) CriOS/91.0.4472.77 Mobile/15E148 Safari/604.1",
+        "Mozilla/5.0 (Linux; Android 11; Pixel 5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.77 Mobile Safari/537.36",
+        # Add more user agents as needed
+    ]
+    return random.choice(user_agents)
+
+@coalesce("scrape", key=lambda url, *args, session=None, **kwargs: payload_key(normalize_url(url), args, kwargs))
+async def scrape_clean_text(url, max_retries=3, delay=5, timeout=10, session=None, use_cache=True):
+    """
+    Scrapes the provided URL for clean textual content and favicon, handling errors gracefully and retrying on failures.
+
+    Parameters:
+    url (str): The URL of the webpage to scrape.
+    max_retries (int): Maximum number of retries. Default is 3.
+    delay (float): Delay between retries in seconds. Default is 5 seconds.
+    timeout (float): Timeout for the request in seconds. Default is 10 seconds.
+    session (aiohttp.ClientSession): An aiohttp session to reuse. Defaults to the shared session.
+    use_cache (bool): Whether the page cache may be used. Default is True.
+
+    Returns:
+    dict: A dictionary containing 'url', 'cleaned_html', and optionally 'favicon'.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            page = await fetch_page(url, "clean", session=session, timeout=timeout, use_cache=use_cache)
+            result = {
+                "url": url,
+                "cleaned_html": page["content"],
+                "favicon": page["favicon"]
+            }
+            return result
+
+        except UnsupportedContentType as e:
+            logger.error(str(e))
+            raise HTTPException(status_code=415, detail=str(e))
+        except ClientError as e:
+            logger.error(f"HTTP error occurred while scraping {url}: {e}")
+            raise HTTPException(status_code=getattr(e, "status", 502), detail=str(e))
+        except Exception as e:
+            logger.error(f"An error occurred while scraping {url}: {e}")
+            if attempt < max_retries:
+                delay_time = random.uniform(0.5, delay)  # Random delay between retries
+                logger.info(f"Retrying in {delay_time:.2f} seconds...")
+                await asyncio.sleep(delay_time)
+            else:
+                raise HTTPException(status_code=500, detail=str(e))
+    return None
+
+@functions_router.post('/scrape')
+async def scrape_endpoint(request: ScrapeRequest):
+    """
+    Handle POST requests to scrape URLs and return scraped data.
+    """
+    try:
+        scraped_data = await scrape_clean_text(request.url, session=get_session(), use_cache=not request.no_cache)
+        return scraped_data
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+@functions_router.post('/searx')
+async def searx_endpoint(input: SearchQuery):
+    try:
+        query = input.search_query
+        session = get_session()
+        started = asyncio.get_running_loop().time()
+        searxng_results = await search_with_searxng(query, session, timeout=SEARCH_DEADLINE)
+        # Scraping gets what is left of the deadline
+        elapsed = asyncio.get_running_loop().time() - started
+        results = await gather_sources(searxng_results['results'], session, deadline=max(SEARCH_DEADLINE - elapsed, 0), use_cache=not input.no_cache)
+        results = await select_passages(query, results)
+        
+        # Prepare the prompt for the LLM
+        prompt = f"""You are a web research assistant. Answer the following question based on the provided sources denoted by <id[number]>. Always cite your sources based on the provided id.\n\nQuestion: {query}\n\nSources:\n"""
+        for result in results:
+            prompt += f"id:[{result['number']}.]\ncontent:{result['content']}\n\n"
+            logger.debug("PROMPT SENT:", prompt)
+        
+        # Send the prompt to the LLM
+        try:
+            answer = await ollama_client.generate({"model": SEARX_MODEL, "prompt": prompt, "options": {"num_ctx": SEARCH_NUM_CTX}})
+            answer = answer.get("response", "No answer generated.")
+        except ClientError:
+            answer = "Failed to generate an answer from the LLM."
+        
+        return {
+            "question": query,
+            "sources": results,
+            "answer": answer
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@functions_router.get("/cache")
+async def page_cache_stats():
+    return page_cache.stats()
+
+@functions_router.delete("/cache")
+async def purge_page_cache(url: str = None):
+    """
+    Purge one URL from the page cache, or the whole cache when no URL is given.
+    """
+    removed = await page_cache.purge(url)
+    return {"purged": removed}
+
+@functions_router.get("/")
+async def function_get():
     return {"message": "Function endpoint not yet implemented"}
\ No newline at end of file
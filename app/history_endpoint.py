@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from app.database import SessionLocal, ChatHistory, ChatMessage
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 50  # Default number of sessions or messages per page
+HISTORY_MAX_PAGE_SIZE = 1000
+EXPORT_BATCH_SIZE = 200  # Sessions read per database round trip during an export
+
+history_router = APIRouter()
+
+def session_fields(row):
+    return {
+        "session_id": row.session_id,
+        "model": row.model,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+        "message_count": row.message_count,
+    }
+
+def read_sessions(before_id=None, limit=HISTORY_PAGE_SIZE, model=None, since=None, until=None, with_legacy=False):
+    """
+    One page of sessions, newest first.
+    Pages are keyed on the primary key: the next page starts below the last id returned,
+    so every page costs the same however deep the client pages.
+    """
+    columns = [ChatHistory.id, ChatHistory.session_id, ChatHistory.model, ChatHistory.created_at,
+               ChatHistory.updated_at, ChatHistory.message_count]
+    if with_legacy:
+        columns.append(ChatHistory.messages)
+    db = SessionLocal()
+    try:
+        query = db.query(*columns)
+        if before_id is not None:
+            query = query.filter(ChatHistory.id < before_id)
+        if model:
+            query = query.filter(ChatHistory.model == model)
+        if since:
+            query = query.filter(ChatHistory.created_at >= since)
+        if until:
+            query = query.filter(ChatHistory.created_at < until)
+        return query.order_by(ChatHistory.id.desc()).limit(limit).all()
+    finally:
+        db.close()
+
+def read_messages(session_ids, after_seq=None, limit=None):
+    """Messages of the given sessions in order, through the (session_id, seq) index."""
+    db = SessionLocal()
+    try:
+        query = db.query(ChatMessage.session_id, ChatMessage.seq, ChatMessage.message, ChatMessage.created_at)
+        query = query.filter(ChatMessage.session_id.in_(session_ids))
+        if after_seq is not None:
+            query = query.filter(ChatMessage.seq > after_seq)
+        query = query.order_by(ChatMessage.session_id, ChatMessage.seq)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+    finally:
+        db.close()
+
+def read_session(session_id):
+    db = SessionLocal()
+    try:
+        return db.query(ChatHistory).filter(ChatHistory.session_id == session_id).first()
+    finally:
+        db.close()
+
+@history_router.get("/sessions")
+async def list_sessions(
+    cursor: int = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    model: str = None,
+    since: datetime = None,
+    until: datetime = None,
+):
+    """
+    List sessions, newest first, optionally filtered by model and creation time.
+    Pass the returned next_cursor to get the following page, it is null on the last page.
+    """
+    rows = await asyncio.to_thread(read_sessions, cursor, limit, model, since, until)
+    return {
+        "sessions": [session_fields(row) for row in rows],
+        "next_cursor": rows[-1].id if len(rows) == limit else None,
+    }
+
+@history_router.get("/sessions/{session_id}")
+async def list_messages(
+    session_id: str,
+    cursor: int = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+):
+    """The messages of a session in order, paginated on the message sequence number."""
+    session = await asyncio.to_thread(read_session, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    rows = await asyncio.to_thread(read_messages, [session_id], cursor, limit)
+    messages = [row.message for row in rows]
+    if cursor is None and not rows and session.messages:
+        messages = session.messages  # Stored before chat_messages existed
+    return {
+        **session_fields(session),
+        "messages": messages,
+        "next_cursor": rows[-1].seq if len(rows) == limit else None,
+    }
+
+@history_router.get("/export")
+async def export_sessions(model: str = None, since: datetime = None, until: datetime = None,
+                          batch_size: int = Query(EXPORT_BATCH_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE)):
+    """
+    Stream every matching session with its messages as NDJSON, newest first.
+
+    The table is walked in batches of batch_size sessions, each read in its own short
+    transaction on a worker thread: memory stays bounded and the history writer is never
+    blocked behind a long export.
+    """
+    async def rows():
+        before_id = None
+        exported = 0
+        while True:
+            sessions = await asyncio.to_thread(read_sessions, before_id, batch_size, model, since, until, True)
+            if not sessions:
+                break
+            messages = {}
+            for row in await asyncio.to_thread(read_messages, [session.session_id for session in sessions]):
+                messages.setdefault(row.session_id, []).append(row.message)
+            lines = []
+            for session in sessions:
+                record = session_fields(session)
+                record["messages"] = messages.get(session.session_id) or session.messages or []
+                lines.append(json.dumps(record) + "\n")
+            yield "".join(lines)
+            exported += len(sessions)
+            before_id = sessions[-1].id
+            if len(sessions) < batch_size:
+                break
+        logger.info(f"Exported {exported} chat sessions")
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from app.database import SessionLocal, ChatHistory, ChatMessage
+from app.metrics import stage, DB_COMMIT_SECONDS, DB_ROWS
+
+logger = logging.getLogger(__name__)
+
+HISTORY_BATCH_SIZE = 200  # Maximum number of queued writes committed in one transaction
+HISTORY_FLUSH_INTERVAL = 0.05  # Seconds to wait for more writes before committing a batch
+HISTORY_QUEUE_SIZE = 10000  # Writes waiting for the database before callers are slowed down
+HISTORY_WRITE_ATTEMPTS = 3  # Tries of a single write once its batch failed, e.g. after another process wrote the same session
+
+def message_fields(message):
+    """Role and content of a chat message or of an Ollama chat response."""
+    inner = message.get("message") if isinstance(message.get("message"), dict) else message
+    return inner.get("role"), inner.get("content")
+
+class ChatHistoryWriter:
+    """
+    Persists chat history off the request path.
+
+    Writes are queued and committed by a background task in batches, one transaction
+    per batch, on a worker thread so the event loop never waits for SQLite.
+    Messages are appended as rows of chat_messages, numbered per session inside the
+    transaction that writes them, so several processes can append to the same session.
+    When a batch fails its writes are retried one by one, a bad write only loses itself.
+    """
+
+    def __init__(self, batch_size=HISTORY_BATCH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL, queue_size=HISTORY_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.queue = None
+        self._task = None
+        self._pending = {}  # session_id -> number of its writes queued or being written
+        self._written = {}  # session_id -> asyncio.Event set once its writes are committed, created by waiters
+
+    async def start(self):
+        if self._task is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._run())
+            logger.debug("Chat history writer started")
+
+    async def stop(self):
+        """Write everything still queued, then stop the background task."""
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        logger.debug("Chat history writer stopped")
+
+    async def flush(self, session_id=None):
+        """Wait until every queued write, or only the writes of `session_id`, is committed."""
+        if self.queue is None:
+            return
+        if session_id is None:
+            await self.queue.join()
+        elif self._pending.get(session_id):
+            await self._written.setdefault(session_id, asyncio.Event()).wait()
+
+    async def _put(self, op):
+        if self._task is None:
+            await self.start()
+        self._pending[op[1]] = self._pending.get(op[1], 0) + 1
+        await self.queue.put(op)
+
+    def _done(self, op):
+        session_id = op[1]
+        self._pending[session_id] -= 1
+        if not self._pending[session_id]:
+            del self._pending[session_id]
+            event = self._written.pop(session_id, None)
+            if event is not None:
+                event.set()
+
+    async def create_session(self, session_id, model, messages=()):
+        now = datetime.utcnow()
+        await self._put(("session", session_id, model, now))
+        if messages:
+            await self._put(("messages", session_id, list(messages), now))
+
+    async def append(self, session_id, messages):
+        await self._put(("messages", session_id, list(messages), datetime.utcnow()))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} chat history entries: {e}")
+            finally:
+                for op in batch:
+                    self._done(op)
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        written = len(batch)
+        with stage(DB_COMMIT_SECONDS):
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                if len(batch) > 1:
+                    logger.warning(f"Failed to write {len(batch)} chat history entries at once, writing them one by one: {e}")
+                written = sum(self._write_one(op) for op in batch)
+        DB_ROWS.inc(written)
+
+    def _write_one(self, op):
+        """Write a single entry, retrying conflicts with other processes. Returns whether it was written."""
+        for attempt in range(1, HISTORY_WRITE_ATTEMPTS + 1):
+            try:
+                self._write_batch([op])
+                return True
+            except (IntegrityError, OperationalError) as e:
+                # Seq taken or database locked by another process
+                error = e
+                time.sleep(0.05 * attempt)
+            except Exception as e:
+                error = e
+                break
+        logger.error(f"Failed to write chat history entry of session {op[1]}: {error}")
+        return False
+
+    def _write_batch(self, batch):
+        db = SessionLocal()
+        next_seq = {}  # session_id -> next seq, for sessions already written in this transaction
+        try:
+            # Take the write lock first, so the seq read below cannot be taken by another process before the commit
+            db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            for op in batch:
+                if op[0] == "session":
+                    _, session_id, model, created_at = op
+                    db.add(ChatHistory(session_id=session_id, model=model, created_at=created_at, updated_at=created_at, message_count=0))
+                    db.flush()
+                    next_seq[session_id] = 0
+                elif op[0] == "messages":
+                    _, session_id, messages, created_at = op
+                    seq = next_seq.get(session_id)
+                    if seq is None:
+                        seq = db.query(func.coalesce(func.max(ChatMessage.seq) + 1, 0)).filter(ChatMessage.session_id == session_id).scalar()
+                    for message in messages:
+                        role, content = message_fields(message)
+                        db.add(ChatMessage(session_id=session_id, seq=seq, role=role, content=content, message=message, created_at=created_at))
+                        seq += 1
+                    db.query(ChatHistory).filter(ChatHistory.session_id == session_id).update({
+                        ChatHistory.message_count: seq,
+                        ChatHistory.updated_at: created_at,
+                    })
+                    next_seq[session_id] = seq
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
@@ -0,0 +1,48 @@
+import aiohttp
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Connection pool settings for the shared aiohttp session
+POOL_LIMIT = 100  # Maximum number of simultaneous connections
+POOL_LIMIT_PER_HOST = 20  # Maximum number of simultaneous connections to a single host
+KEEPALIVE_TIMEOUT = 30  # Seconds an idle connection is kept open for reuse
+CONNECT_TIMEOUT = 5  # Seconds allowed to establish a connection
+READ_TIMEOUT = 300  # Seconds allowed between two reads (LLM generations can be slow)
+
+_session = None
+
+def create_session():
+    """Create a new aiohttp session backed by a pooled connector."""
+    connector = aiohttp.TCPConnector(
+        limit=POOL_LIMIT,
+        limit_per_host=POOL_LIMIT_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def get_session():
+    """
+    Return the process-wide aiohttp session.
+
+    The session is normally opened by the FastAPI lifespan, but it is created lazily
+    here as well so that the clients keep working outside of the app (scripts, shells).
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = create_session()
+        logger.debug("Shared HTTP session created")
+    return _session
+
+async def start_http_client():
+    get_session()
+    logger.info(f"HTTP connection pool started (limit={POOL_LIMIT}, per_host={POOL_LIMIT_PER_HOST})")
+
+async def close_http_client():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("HTTP connection pool closed")
+    _session = None
@@ -1,118 +1,341 @@
-from fastapi import FastAPI, Depends, HTTPException
-from pydantic import BaseModel
-from app.ollama_client import OllamaClient
-from app.database import SessionLocal, ChatHistory
-from app.tasks import TaskManager
-from app.functions_endpoint import scrape_clean_text
-from app.functions_endpoint import functions_router  # Import the functions router
-from sqlalchemy.orm import Session
-import uuid
-import logging
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-class ChatRequest(BaseModel):
-    model: str
-    messages: list
-    stream: bool = False
-
-class EmbedRequest(BaseModel):
-    model: str
-    input: list
-    truncate: bool = True
-
-class SiriRequest(BaseModel):
-    type: str
-    model: str
-    messages: list
-    stream: bool = False
-    url: str = None
-    options: dict = None
-    images: list = None
-    searchQ: str
-
-app = FastAPI()
-ollama_client = OllamaClient()
-task_manager = TaskManager()
-
-# Include the functions router
-app.include_router(functions_router, prefix="/functions", tags=["functions"])
-
-@app.get("/")
-async def read_root():
-    logging.debug("Root endpoint accessed")
-    return {"message": "Ollama Backend is running"}
-
-@app.get("/api/tags")
-async def list_models():
-    logging.debug("List models endpoint accessed")
-    return await ollama_client.list_models()
-
-@app.post("/api/chat")
-async def generate_chat(request: ChatRequest):
-    db = SessionLocal()
-    try:
-        session_id = str(uuid.uuid4())
-        chat_history = ChatHistory(session_id=session_id, messages=request.messages)
-        db.add(chat_history)
-        db.commit()
-        logging.debug(f"Chat request received with session_id {session_id}")
-        response = await ollama_client.generate_chat(request.dict())
-        chat_history.messages.append(response)
-        db.commit()
-        logging.debug(f"Chat response generated for session_id {session_id}: {response}")
-        return response
-    except Exception as e:
-        logging.error(f"Error processing chat request: {e}")
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
-
-@app.post("/api/embed")
-async def generate_embeddings(request: EmbedRequest):
-    logging.debug("Embedding request received")
-    response = await ollama_client.generate_embeddings(request.dict())
-    logging.debug("Embedding response generated")
-    return response
-
-@app.post("/siri")
-async def siri_post(request: SiriRequest):
-    task_id = str(uuid.uuid4())
-    task_data = {
-        "model": request.model,
-        "messages": request.messages,
-        "stream": request.stream,
-    }
-    if request.type == "summarize_url":
-        task_data["url"] = request.url
-    if request.type == "search_web":
-        task_data["searchQ"] = request.searchQ
-    if request.options:
-        task_data["options"] = request.options
-    if request.images:
-        task_data["images"] = request.images
-    task_manager.add_task(task_id, request.type, task_data)
-    logging.debug(f"Siri task {task_id} added with type {request.type}")
-    return {
-        "received": True,
-        "url": f"http://localhost:8000/siri/status/{task_id}",
-        "task_id": task_id,
-        "status": "scheduled"
-    }
-
-@app.get("/siri/status/{task_id}")
-async def siri_status(task_id: str):
-    status = task_manager.get_task_status(task_id)
-    logging.debug(f"Siri status checked for task_id {task_id}: {status['status']}")
-    return status
-
-@app.post("/functions")
-async def functions(request: dict):
-    # Basic structure to handle custom functions
-    logging.debug("Functions endpoint accessed")
-    return {"status": "received", "data": request}
-
-if __name__ == "__main__": 
+import time
+IMPORT_STARTED = time.perf_counter()  # Cold start is measured from here
+
+from fastapi import FastAPI, Depends, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+from app.ollama_client import ollama_client, merge_chat_chunks
+from app.history_writer import ChatHistoryWriter
+from app.database import init_db, engine
+from app.chat_sessions import ChatSessionStore
+from app.tasks import TaskManager, QueueFullError
+from app.functions_endpoint import scrape_clean_text
+from app.functions_endpoint import functions_router  # Import the functions router
+from app.history_endpoint import history_router
+from app.http_client import start_http_client, close_http_client
+from app.embed_cache import EmbeddingCache
+from app.answer_cache import AnswerCache
+from app.embed_batcher import EmbeddingBatcher
+from app.extraction import start_extraction_pool, stop_extraction_pool
+from app.singleflight import singleflight_stats
+from app.page_cache import page_cache
+from app.metrics import register_collector, render as render_metrics
+from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+import asyncio
+import uuid
+import json
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class ChatRequest(BaseModel):
+    model: str
+    messages: list
+    stream: bool = False
+    session_id: str = None  # Continue a stored session, messages then only holds the new messages
+
+class EmbedRequest(BaseModel):
+    model: str
+    input: list
+    truncate: bool = True
+
+class SiriRequest(BaseModel):
+    type: str
+    model: str
+    messages: list
+    stream: bool = False
+    url: str = None
+    options: dict = None
+    images: list = None
+    searchQ: str
+    no_cache: bool = False  # Skip the page cache for scraped pages
+    priority: int = 0  # Tasks with a higher priority are started first
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # One pooled HTTP session is shared by the Ollama client, the task manager and the functions router
+    await start_http_client()
+    # Creates the tables and migrates older databases, outside of the event loop
+    await asyncio.to_thread(init_db)
+    # The caches' databases are opened here rather than on import
+    await asyncio.to_thread(embedding_cache.open)
+    await asyncio.to_thread(answer_cache.open)
+    # Opens the shared task store, tasks left waiting by a previous run are picked up again
+    await task_manager.start()
+    await ollama_client.start()
+    await history_writer.start()
+    start_extraction_pool()
+    logging.info(f"Startup complete in {time.perf_counter() - started:.2f}s, {started - IMPORT_STARTED:.2f}s spent importing the app")
+    try:
+        yield
+    finally:
+        await task_manager.stop()
+        await ollama_client.stop()
+        await history_writer.stop()
+        await close_http_client()
+        embedding_cache.close()
+        answer_cache.close()
+        stop_extraction_pool()
+        engine.dispose()
+
+class FirstRequestLogger:
+    """ASGI middleware logging how long the first request to every endpoint took, cold caches and connections included."""
+
+    def __init__(self, app):
+        self.app = app
+        self.seen = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        await self.app(scope, receive, send)
+        route = scope.get("route")
+        if route is not None and id(route) not in self.seen:
+            self.seen.add(id(route))
+            logging.info(f"First {scope['method']} {scope['path']} request served in {(time.perf_counter() - started) * 1000:.1f}ms, "
+                         f"{time.perf_counter() - IMPORT_STARTED:.1f}s after start")
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(FirstRequestLogger)
+embedding_cache = EmbeddingCache()
+# Concurrent embedding requests for the same model are merged into one Ollama call
+embedding_batcher = EmbeddingBatcher(ollama_client)
+answer_cache = AnswerCache(embedding_cache, embedding_batcher)
+task_manager = TaskManager(answer_cache=answer_cache, embedder=embedding_batcher)
+history_writer = ChatHistoryWriter()
+chat_sessions = ChatSessionStore(writer=history_writer)
+
+def cache_metrics():
+    embed = embedding_cache.stats()
+    pages = page_cache.stats()
+    flights = singleflight_stats()
+    answers = answer_cache.stats()
+    return [
+        ("sirillama_embed_cache_requests", "Embedding cache lookups by result",
+         {(("result", "hit"),): embed["hits"], (("result", "disk_hit"),): embed["disk_hits"], (("result", "miss"),): embed["misses"]}),
+        ("sirillama_embed_cache_bytes", "Bytes held by the in-memory embedding cache", {(): embed["bytes"]}),
+        ("sirillama_page_cache_requests", "Page cache lookups by result",
+         {(("result", "hit"),): pages["hits"], (("result", "revalidated"),): pages["revalidated"], (("result", "miss"),): pages["misses"]}),
+        ("sirillama_answer_cache_requests", "Semantic answer cache lookups by result",
+         {(("result", "hit"),): answers["hits"], (("result", "miss"),): answers["misses"]}),
+        ("sirillama_page_cache_disk_bytes", "Bytes held by the on-disk page cache", {(): pages["disk_bytes"]}),
+        ("sirillama_coalesced_calls", "Upstream calls by single-flight outcome",
+         {(("call", name), ("outcome", outcome)): stats[outcome] for name, stats in flights.items() for outcome in ("executed", "coalesced")}),
+    ]
+
+def ollama_metrics():
+    backends = ollama_client.stats()
+    return [
+        ("sirillama_ollama_backend_up", "Whether an Ollama backend passes its health checks", {(("backend", b["url"]),): int(b["healthy"]) for b in backends}),
+        ("sirillama_ollama_backend_outstanding", "Requests in progress per Ollama backend", {(("backend", b["url"]),): b["outstanding"] for b in backends}),
+    ]
+
+def task_metrics():
+    return [
+        ("sirillama_task_queue_depth", "Siri tasks waiting for a worker", {(("pool", pool),): depth for pool, depth in task_manager.queue_depths().items()}),
+        ("sirillama_tasks_running", "Siri tasks being executed", {(): len(task_manager.running)}),
+    ]
+
+register_collector(cache_metrics)
+register_collector(ollama_metrics)
+register_collector(task_metrics)
+
+# Include the functions router
+app.include_router(functions_router, prefix="/functions", tags=["functions"])
+app.include_router(history_router, prefix="/api/history", tags=["history"])
+
+@app.get("/")
+async def read_root():
+    logging.debug("Root endpoint accessed")
+    return {"message": "Ollama Backend is running"}
+
+@app.get("/api/tags")
+async def list_models():
+    logging.debug("List models endpoint accessed")
+    return await ollama_client.list_models()
+
+async def prepare_session(request: ChatRequest):
+    """
+    Store the new messages of a chat request and build the payload sent to Ollama.
+    Without a session_id a new session is started and the messages are sent as they are,
+    with one the new messages are appended to the stored conversation and sent along with
+    its (windowed) history.
+    """
+    payload = request.dict(exclude={"session_id"})
+    if not request.session_id:
+        session_id = str(uuid.uuid4())
+        await history_writer.create_session(session_id, request.model, request.messages)
+        return session_id, payload
+    session_id = request.session_id
+    history = await chat_sessions.load(session_id)
+    if history is None:
+        await history_writer.create_session(session_id, request.model, request.messages)
+    else:
+        await history_writer.append(session_id, request.messages)
+    payload["messages"] = chat_sessions.update(session_id, history or [], request.messages)
+    return session_id, payload
+
+@app.get("/api/backends")
+async def ollama_backends():
+    # Health, load and loaded models of every Ollama backend
+    return ollama_client.stats()
+
+@app.post("/api/chat")
+async def generate_chat(request: ChatRequest):
+    if request.stream:
+        return await stream_chat(request)
+    try:
+        session_id, payload = await prepare_session(request)
+        logging.debug(f"Chat request received with session_id {session_id}")
+        response = await ollama_client.generate_chat(payload)
+        await history_writer.append(session_id, [response])
+        chat_sessions.extend(session_id, [response])
+        logging.debug(f"Chat response generated for session_id {session_id}: {response}")
+        return {**response, "session_id": session_id}
+    except Exception as e:
+        logging.error(f"Error processing chat request: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def stream_chat(request: ChatRequest):
+    """
+    Pass Ollama's NDJSON chunks through to the client as they arrive.
+    The assembled reply is stored in the chat history once the stream ends.
+    """
+    try:
+        session_id, payload = await prepare_session(request)
+        logging.debug(f"Streaming chat request received with session_id {session_id}")
+        chunks = ollama_client.stream_chat(payload)
+        # Wait for the first chunk so that upstream errors still surface as a proper HTTP error
+        first_chunk = await anext(chunks, None)
+    except Exception as e:
+        logging.error(f"Error processing chat request: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def relay():
+        lines = []
+        try:
+            if first_chunk is not None:
+                lines.append(first_chunk)
+                yield first_chunk
+            async for line in chunks:
+                lines.append(line)
+                yield line
+        finally:
+            await chunks.aclose()
+            try:
+                response = merge_chat_chunks([json.loads(line) for line in lines])
+                await history_writer.append(session_id, [response])
+                chat_sessions.extend(session_id, [response])
+                logging.debug(f"Chat response streamed for session_id {session_id}: {response}")
+            except Exception as e:
+                logging.error(f"Error storing streamed chat response for session_id {session_id}: {e}")
+
+    return StreamingResponse(relay(), media_type="application/x-ndjson", headers={"X-Session-Id": session_id})
+
+@app.post("/api/embed")
+async def generate_embeddings(request: EmbedRequest):
+    logging.debug("Embedding request received")
+    response = await embedding_cache.embed(embedding_batcher, request.dict())
+    logging.debug("Embedding response generated")
+    return response
+
+@app.get("/api/embed/stats")
+async def embedding_cache_stats():
+    return {**embedding_cache.stats(), "batching": embedding_batcher.stats()}
+
+@app.get("/api/answers/stats")
+async def answer_cache_stats():
+    # Semantic answer cache of search_web tasks
+    return answer_cache.stats()
+
+@app.get("/api/coalescing/stats")
+async def coalescing_stats():
+    # Number of upstream calls made and of identical concurrent calls that shared them
+    return singleflight_stats()
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format: per-stage latency histograms, error counters, cache and queue gauges
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.post("/siri")
+async def siri_post(request: SiriRequest):
+    task_id = str(uuid.uuid4())
+    task_data = {
+        "model": request.model,
+        "messages": request.messages,
+        "stream": request.stream,
+    }
+    if request.type == "summarize_url":
+        task_data["url"] = request.url
+    if request.type == "search_web":
+        task_data["searchQ"] = request.searchQ
+    if request.options:
+        task_data["options"] = request.options
+    if request.images:
+        task_data["images"] = request.images
+    if request.no_cache:
+        task_data["no_cache"] = True
+    try:
+        await task_manager.add_task(task_id, request.type, task_data, priority=request.priority)
+    except QueueFullError as e:
+        logging.warning(f"Siri task rejected: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    logging.debug(f"Siri task {task_id} added with type {request.type}")
+    return {
+        "received": True,
+        "url": f"http://localhost:8000/siri/status/{task_id}",
+        "task_id": task_id,
+        "status": "scheduled"
+    }
+
+@app.get("/siri/status/{task_id}")
+async def siri_status(task_id: str, timings: bool = False, wait: float = 0):
+    if wait > 0:
+        # Long poll: answer as soon as the task finishes instead of making the client poll again
+        await task_manager.wait_for_task(task_id, wait)
+    status = await task_manager.get_task_status(task_id)
+    logging.debug(f"Siri status checked for task_id {task_id}: {status.get('status')}")
+    if not timings:
+        # Per-stage durations (queue wait, search, scrapes, Ollama) are only returned on request
+        status = {key: value for key, value in status.items() if key != "timings"}
+    return status
+
+@app.get("/siri/events/{task_id}")
+async def siri_events(task_id: str):
+    """
+    Server-Sent Events for a task: "status" events on every status change, "token" events with
+    the reply as it is generated (for tasks sent with stream=true), ending with the final status.
+    """
+    if await task_manager.get_task(task_id) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def event_stream():
+        async for event, data in task_manager.task_events(task_id):
+            if event == "keepalive":
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.delete("/siri/{task_id}")
+async def siri_cancel(task_id: str):
+    task = await task_manager.cancel_task(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    logging.debug(f"Siri task {task_id} cancel requested: {task['status']}")
+    return {"task_id": task_id, "status": task["status"]}
+
+@app.post("/functions")
+async def functions(request: dict):
+    # Basic structure to handle custom functions
+    logging.debug("Functions endpoint accessed")
+    return {"status": "received", "data": request}
+
+if __name__ == "__main__": 
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Latency buckets in seconds, wide enough for LLM generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_collectors = []
+_lock = threading.Lock()  # Metrics are also updated from worker threads (database writer)
+
+# Timing breakdown of the Siri task being executed, set by TaskManager.execute_task
+current_timings = ContextVar("current_timings", default=None)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        with _lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, data in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {data[-1]}")
+        return lines
+
+def register_collector(func):
+    """
+    Register a function called at every scrape, returning (name, documentation, {labels tuple: value})
+    tuples exported as gauges. Used for values that already live elsewhere, like cache statistics.
+    """
+    _collectors.append(func)
+
+def record_timing(name, seconds):
+    """Add a stage duration to the timing breakdown of the current Siri task, if any."""
+    timings = current_timings.get()
+    if timings is None or name is None:
+        return
+    seconds = round(seconds, 4)
+    if name in timings:
+        previous = timings[name]
+        timings[name] = (previous if isinstance(previous, list) else [previous]) + [seconds]
+    else:
+        timings[name] = seconds
+
+@contextmanager
+def stage(histogram, timing=None, **labels):
+    """Time a block into a histogram and into the current task's timing breakdown under `timing`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, **labels)
+        record_timing(timing, elapsed)
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for metric in _registry:
+            lines.extend(metric.render())
+    for collector in _collectors:
+        for name, documentation, values in collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+# Stages of a request
+SEARXNG_SECONDS = Histogram("sirillama_searxng_seconds", "Duration of SearXNG queries")
+SCRAPE_SECONDS = Histogram("sirillama_scrape_seconds", "Duration of page scrapes (download and extraction)", ["backend"])
+EXTRACTION_CPU_SECONDS = Histogram("sirillama_extraction_cpu_seconds", "CPU time spent extracting text from HTML", ["backend"])
+OLLAMA_TTFT_SECONDS = Histogram("sirillama_ollama_time_to_first_token_seconds", "Time until Ollama sends the first chunk", ["endpoint"])
+OLLAMA_SECONDS = Histogram("sirillama_ollama_seconds", "Total duration of Ollama requests", ["endpoint"])
+RETRIEVAL_SECONDS = Histogram("sirillama_retrieval_seconds", "Duration of chunk ranking for search prompts", ["scorer"])
+DB_COMMIT_SECONDS = Histogram("sirillama_db_commit_seconds", "Duration of chat history batch commits")
+TASK_QUEUE_WAIT_SECONDS = Histogram("sirillama_task_queue_wait_seconds", "Time Siri tasks wait for a worker", ["type"])
+TASK_SECONDS = Histogram("sirillama_task_seconds", "Execution time of Siri tasks", ["type"])
+
+EMBED_BATCH_SIZE = Histogram("sirillama_embed_batch_inputs", "Inputs per embedding call sent to Ollama",
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+SCRAPE_ERRORS = Counter("sirillama_scrape_errors_total", "Page scrapes that failed", ["backend"])
+OLLAMA_ERRORS = Counter("sirillama_ollama_errors_total", "Ollama requests that failed", ["endpoint"])
+DB_ROWS = Counter("sirillama_db_writes_total", "Chat history writes committed")
+TASKS = Counter("sirillama_tasks_total", "Finished Siri tasks", ["type", "status"])
+TASKS_REJECTED = Counter("sirillama_tasks_rejected_total", "Siri tasks rejected because the queue was full", ["type"])
@@ -1,21 +1,306 @@
-import aiohttp
-import asyncio
-
-class OllamaClient:
-    def __init__(self, base_url="http://localhost:11434"):
-        self.base_url = base_url
-
-    async def list_models(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.base_url}/api/tags") as response:
-                return await response.json()
-
-    async def generate_chat(self, payload):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/api/chat", json=payload) as response:
-                return await response.json()
-
-    async def generate_embeddings(self, payload):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/api/embed", json=payload) as response:
-                return await response.json()
\ No newline at end of file
+import aiohttp
+import asyncio
+import json
+import logging
+import time
+from contextlib import contextmanager
+from app.http_client import get_session
+from app.singleflight import coalesce, payload_key
+from app.metrics import stage, record_timing, OLLAMA_SECONDS, OLLAMA_TTFT_SECONDS, OLLAMA_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Ollama nodes requests are spread across
+OLLAMA_BACKENDS = ["http://localhost:11434"]  # Adjust to the URLs of your Ollama instances
+HEALTH_CHECK_INTERVAL = 10  # Seconds between probes of /api/ps and /api/tags on every backend
+HEALTH_CHECK_TIMEOUT = 5  # Seconds before a probe counts as failed
+BACKEND_PARALLEL = 4  # Requests a node serves at once (OLLAMA_NUM_PARALLEL), busier nodes lose their model preference
+
+# Model warm-up
+WARMUP_MODELS = []  # Models loaded on every backend at startup and kept in memory, e.g. ["gemma2:2b-instruct-q6_K"]
+KEEP_ALIVE = "30m"  # How long Ollama keeps a warmed-up model loaded after its last request
+KEEP_ALIVE_INTERVAL = 5 * 60  # Seconds between keep-alive pings of the warmed-up models, keep it below KEEP_ALIVE
+
+def merge_chat_chunks(chunks):
+    """
+    Assemble the NDJSON chunks of a streamed /api/chat completion into a single response.
+
+    The final chunk carries the timing statistics, the message content is the concatenation
+    of the content of every chunk.
+    """
+    if not chunks:
+        return {}
+    content = "".join(chunk.get("message", {}).get("content", "") for chunk in chunks)
+    response = dict(chunks[-1])
+    message = dict(response.get("message") or {"role": "assistant"})
+    message["content"] = content
+    response["message"] = message
+    return response
+
+class Backend:
+    """One Ollama node, with the state used to route requests to it."""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.healthy = True
+        self.outstanding = 0  # Requests in progress
+        self.loaded = set()  # Models in memory, from /api/ps and from the requests sent
+        self.models = None  # Models available, from /api/tags (None until probed)
+        self.failures = 0
+
+    @contextmanager
+    def track(self):
+        self.outstanding += 1
+        try:
+            yield
+        finally:
+            self.outstanding -= 1
+
+    def rank(self, model):
+        # Prefer nodes with the model in memory while they have free slots, then nodes that have it, then the least loaded
+        warm = model in self.loaded and self.outstanding < BACKEND_PARALLEL
+        has_model = self.models is None or model in self.models
+        return (not warm, not has_model, self.outstanding)
+
+class OllamaClient:
+    def __init__(self, base_urls=OLLAMA_BACKENDS, health_check_interval=HEALTH_CHECK_INTERVAL,
+                 warmup_models=WARMUP_MODELS, keep_alive=KEEP_ALIVE, keep_alive_interval=KEEP_ALIVE_INTERVAL):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.backends = [Backend(url) for url in base_urls]
+        self.health_check_interval = health_check_interval
+        self.warmup_models = list(warmup_models)
+        self.keep_alive = keep_alive
+        self.keep_alive_interval = keep_alive_interval
+        self._background = []
+
+    @property
+    def key(self):
+        # Identifies the cluster in coalescing keys
+        return tuple(backend.url for backend in self.backends)
+
+    def candidates(self, model=None):
+        """Backends in the order a request for `model` should try them."""
+        healthy = [backend for backend in self.backends if backend.healthy]
+        # When every node is marked down, try them all rather than failing without a request
+        return sorted(healthy or self.backends, key=lambda backend: backend.rank(model))
+
+    def mark_down(self, backend, error):
+        if backend.healthy:
+            logger.warning(f"Ollama backend {backend.url} marked down: {error!r}")
+        backend.healthy = False
+        backend.failures += 1
+
+    async def start(self):
+        if self._background:
+            return
+        if self.health_check_interval:
+            await self.check_health()
+            self._background.append(asyncio.create_task(self._health_loop()))
+        if self.warmup_models:
+            # Models load in the background, the server starts answering meanwhile
+            self._background.append(asyncio.create_task(self._keep_warm()))
+
+    async def stop(self):
+        for task in self._background:
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+        self._background = []
+
+    async def _keep_warm(self):
+        while True:
+            try:
+                await self.warm_up()
+            except Exception as e:
+                logger.error(f"Ollama model warm-up failed: {e}")
+            await asyncio.sleep(self.keep_alive_interval)
+
+    async def warm_up(self, models=None):
+        """Load the models on every healthy backend that has them, resetting their keep-alive timer."""
+        models = self.warmup_models if models is None else models
+        await asyncio.gather(*(
+            self._load_model(backend, model)
+            for backend in self.backends if backend.healthy
+            for model in models if backend.models is None or model in backend.models
+        ))
+
+    async def _load_model(self, backend, model):
+        session = get_session()
+        payload = {"model": model, "keep_alive": self.keep_alive}
+        cold = model not in backend.loaded
+        started = time.perf_counter()
+        try:
+            with backend.track():
+                # A request without a prompt only loads the model
+                async with session.post(f"{backend.url}/api/generate", json=payload) as response:
+                    status = response.status
+                if status == 400:
+                    # Embedding models cannot generate, they are loaded through /api/embed instead
+                    async with session.post(f"{backend.url}/api/embed", json={**payload, "input": ""}) as response:
+                        response.raise_for_status()
+                elif status != 200:
+                    raise aiohttp.ClientError(f"HTTP {status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not load {model} on {backend.url}: {e!r}")
+            return
+        backend.loaded.add(model)
+        if cold:
+            logger.info(f"Model {model} loaded on {backend.url} in {time.perf_counter() - started:.2f}s")
+        else:
+            logger.debug(f"Keep-alive sent for {model} on {backend.url}")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.error(f"Ollama health check failed: {e}")
+
+    async def check_health(self):
+        await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+
+    async def _probe(self, backend):
+        """Refresh the loaded and available models of a backend, marking it up or down."""
+        session = get_session()
+        timeout = aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)
+        try:
+            async with session.get(f"{backend.url}/api/tags", timeout=timeout) as response:
+                response.raise_for_status()
+                tags = await response.json()
+            async with session.get(f"{backend.url}/api/ps", timeout=timeout) as response:
+                # Older Ollama versions have no /api/ps, loaded models are then learnt from requests
+                running = await response.json() if response.status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.mark_down(backend, e)
+            return
+        backend.models = {model.get("name") or model.get("model") for model in tags.get("models", [])}
+        if running is not None:
+            backend.loaded = {model.get("name") or model.get("model") for model in running.get("models", [])}
+        if not backend.healthy:
+            logger.info(f"Ollama backend {backend.url} is back up")
+        backend.healthy = True
+
+    def stats(self):
+        return [
+            {
+                "url": backend.url,
+                "healthy": backend.healthy,
+                "outstanding": backend.outstanding,
+                "loaded": sorted(backend.loaded),
+                "failures": backend.failures,
+            }
+            for backend in self.backends
+        ]
+
+    async def _post(self, path, payload, endpoint, check_status=False):
+        """POST a non-streamed request, failing over to the next backend on connection errors."""
+        session = get_session()
+        model = payload.get("model")
+        error = None
+        try:
+            with stage(OLLAMA_SECONDS, "ollama_total", endpoint=endpoint):
+                for backend in self.candidates(model):
+                    try:
+                        with backend.track():
+                            async with session.post(f"{backend.url}{path}", json=payload) as response:
+                                if check_status:
+                                    response.raise_for_status()
+                                result = await response.json()
+                        if model:
+                            backend.loaded.add(model)
+                        return result
+                    except aiohttp.ClientConnectionError as e:
+                        self.mark_down(backend, e)
+                        error = e
+                raise error
+        except Exception:
+            OLLAMA_ERRORS.inc(endpoint=endpoint)
+            raise
+
+    @coalesce("ollama.tags", key=lambda self: payload_key(self.key))
+    async def list_models(self):
+        """The models of every healthy backend, merged by name."""
+        session = get_session()
+
+        async def tags(backend):
+            try:
+                async with session.get(f"{backend.url}/api/tags") as response:
+                    response.raise_for_status()
+                    return await response.json()
+            except aiohttp.ClientConnectionError as e:
+                self.mark_down(backend, e)
+                return None
+
+        with stage(OLLAMA_SECONDS, endpoint="tags"):
+            backends = [backend for backend in self.backends if backend.healthy] or self.backends
+            results = await asyncio.gather(*(tags(backend) for backend in backends))
+        if all(result is None for result in results):
+            raise aiohttp.ClientConnectionError("No Ollama backend reachable")
+        models = {}
+        for backend, result in zip(backends, results):
+            if result is None:
+                continue
+            backend.models = set()
+            for model in result.get("models", []):
+                name = model.get("name") or model.get("model")
+                backend.models.add(name)
+                models.setdefault(name, model)
+        return {"models": list(models.values())}
+
+    @coalesce("ollama.chat", key=lambda self, payload: payload_key(self.key, payload))
+    async def generate_chat(self, payload):
+        # Ollama streams by default, in that case the NDJSON chunks are assembled into one response
+        if payload.get("stream", True):
+            chunks = []
+            async for line in self.stream_chat(payload):
+                chunks.append(json.loads(line))
+            return merge_chat_chunks(chunks)
+        return await self._post("/api/chat", payload, "chat")
+
+    async def stream_chat(self, payload):
+        """
+        Yield the raw NDJSON lines of a streamed chat completion as soon as Ollama sends them.
+        Connection errors fail over to the next backend until the first line is received.
+        """
+        session = get_session()
+        model = payload.get("model")
+        started = time.perf_counter()
+        first_token = None
+        error = None
+        try:
+            with stage(OLLAMA_SECONDS, "ollama_total", endpoint="chat"):
+                for backend in self.candidates(model):
+                    try:
+                        with backend.track():
+                            async with session.post(f"{backend.url}/api/chat", json={**payload, "stream": True}) as response:
+                                response.raise_for_status()
+                                async for line in response.content:
+                                    if line.strip():
+                                        if first_token is None:
+                                            first_token = time.perf_counter() - started
+                                            OLLAMA_TTFT_SECONDS.observe(first_token, endpoint="chat")
+                                            record_timing("ollama_ttft", first_token)
+                                            backend.loaded.add(model)
+                                        yield line
+                        return
+                    except aiohttp.ClientConnectionError as e:
+                        if first_token is not None:
+                            raise  # Part of the reply was already sent
+                        self.mark_down(backend, e)
+                        error = e
+                raise error
+        except Exception:
+            OLLAMA_ERRORS.inc(endpoint="chat")
+            raise
+
+    @coalesce("ollama.generate", key=lambda self, payload: payload_key(self.key, payload))
+    async def generate(self, payload):
+        """Non-streamed /api/generate completion, raises aiohttp.ClientResponseError on HTTP errors."""
+        return await self._post("/api/generate", {**payload, "stream": False}, "generate", check_status=True)
+
+    @coalesce("ollama.embed", key=lambda self, payload: payload_key(self.key, payload))
+    async def generate_embeddings(self, payload):
+        return await self._post("/api/embed", payload, "embed")
+
+# Shared by the API endpoints, the Siri task workers and the functions router
+ollama_client = OllamaClient()
@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+PAGE_CACHE_TTL = 15 * 60  # Seconds a page is served without revalidation
+PAGE_CACHE_MAX_ENTRIES = 256  # Pages kept in memory
+PAGE_CACHE_DIR = "./page_cache"  # On-disk tier, set to None to keep the cache in memory only
+PAGE_CACHE_MAX_DISK_BYTES = 100 * 1024 * 1024  # Size of the on-disk tier
+
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+
+def normalize_url(url):
+    """
+    Normalize a URL so that trivially different spellings share one cache entry:
+    lowercase scheme and host, no default port, no fragment, sorted query without tracking parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not (scheme == "http" and parts.port == 80) and not (scheme == "https" and parts.port == 443):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(TRACKING_PARAMS)
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+class PageCache:
+    """
+    Cache of scraped pages keyed by extractor and normalized URL.
+
+    Each entry holds the extracted text, the favicon and the validators (ETag/Last-Modified)
+    of the response. Entries older than the TTL are stale: they are revalidated with a
+    conditional GET by the scrapers rather than dropped. Recent pages live in a bounded
+    in-memory LRU, every page is also written to a directory capped in bytes.
+    """
+
+    def __init__(self, ttl=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_MAX_ENTRIES,
+                 cache_dir=PAGE_CACHE_DIR, max_disk_bytes=PAGE_CACHE_MAX_DISK_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.disk_bytes = 0
+        self._disk_lock = threading.Lock()  # Writes run on worker threads, this guards the byte count and eviction
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if cache_dir and os.path.isdir(cache_dir):
+            self.disk_bytes = sum(entry.stat().st_size for entry in self._files())
+
+    @staticmethod
+    def key(kind, url):
+        return f"{kind}:{normalize_url(url)}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _files(self):
+        # Cached pages only, temporary files of writes in progress are left alone
+        return [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.endswith(".json")]
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("key") == key else None
+
+    def _write(self, key, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        data = json.dumps(entry).encode("utf-8")
+        # A temporary file of its own per write, concurrent writes of the same page cannot mix
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._disk_lock:
+                try:
+                    previous = os.path.getsize(path)
+                except OSError:
+                    previous = 0
+                os.replace(tmp_path, path)
+                self.disk_bytes += len(data) - previous
+                if self.disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _evict_disk(self):
+        # Drop the least recently written pages until the directory is back under 90% of its cap
+        files = sorted(self._files(), key=lambda entry: entry.stat().st_mtime)
+        target = self.max_disk_bytes * 0.9
+        for entry in files:
+            if self.disk_bytes <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+
+    async def get(self, kind, url):
+        """Return the cached entry for the URL, fresh or stale, or None."""
+        key = self.key(kind, url)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.cache_dir:
+            entry = await asyncio.to_thread(self._read, key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+        elif self.is_fresh(entry):
+            self.hits += 1
+        return entry
+
+    async def put(self, kind, url, content, favicon=None, etag=None, last_modified=None):
+        key = self.key(kind, url)
+        entry = {
+            "key": key,
+            "url": url,
+            "content": content,
+            "favicon": favicon,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        }
+        self._remember(key, entry)
+        if self.cache_dir:
+            await asyncio.to_thread(self._write, key, entry)
+        return entry
+
+    async def touch(self, entry):
+        """Mark an entry as fresh again after a 304 Not Modified."""
+        entry["fetched_at"] = time.time()
+        self.revalidated += 1
+        self._remember(entry["key"], entry)
+        if self.cache_dir:
+            await asyncio.to_thread(self._write, entry["key"], entry)
+        return entry
+
+    def _remove_files(self, paths):
+        with self._disk_lock:
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    self.disk_bytes -= size
+                except OSError:
+                    pass
+
+    async def purge(self, url=None, kinds=("clean", "trafilatura")):
+        """Remove one URL from the cache, or everything when no URL is given. Returns the number of entries removed."""
+        if url is None:
+            removed = len(self.entries)
+            self.entries.clear()
+            if self.cache_dir and os.path.isdir(self.cache_dir):
+                paths = [entry.path for entry in self._files()]
+                await asyncio.to_thread(self._remove_files, paths)
+                removed = len(paths)
+            return removed
+        removed = 0
+        for kind in kinds:
+            key = self.key(kind, url)
+            in_memory = self.entries.pop(key, None) is not None
+            path = self._path(key) if self.cache_dir else None
+            on_disk = path is not None and os.path.exists(path)
+            if on_disk:
+                await asyncio.to_thread(self._remove_files, [path])
+            removed += in_memory or on_disk
+        return removed
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "disk_bytes": self.disk_bytes,
+            "max_disk_bytes": self.max_disk_bytes,
+        }
+
+page_cache = PageCache()
@@ -0,0 +1,128 @@
+import logging
+import math
+import re
+from collections import Counter
+from app.ollama_client import ollama_client
+from app.metrics import stage, RETRIEVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_EMBED_MODEL = None  # Set to an Ollama embedding model (e.g. "nomic-embed-text") to rank chunks by similarity, None ranks with BM25
+RETRIEVAL_CHUNK_WORDS = 120  # Target size of a chunk, paragraphs are kept whole when they fit
+RETRIEVAL_TOKEN_BUDGET = 2000  # Tokens of source text put into a search prompt
+TOKENS_PER_WORD = 1.3  # Rough token count of an English word, used to estimate prompt sizes
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def estimate_tokens(text):
+    return math.ceil(len(text.split()) * TOKENS_PER_WORD)
+
+def chunk_text(text, chunk_words=RETRIEVAL_CHUNK_WORDS):
+    """
+    Split extracted text into chunks of about `chunk_words` words.
+    Consecutive paragraphs are merged up to the chunk size, longer paragraphs are split.
+    """
+    chunks, current = [], []
+    for paragraph in text.splitlines():
+        words = paragraph.split()
+        if not words:
+            continue
+        if current and len(current) + len(words) > chunk_words:
+            chunks.append(" ".join(current))
+            current = []
+        while len(words) > chunk_words:
+            chunks.append(" ".join(words[:chunk_words]))
+            words = words[chunk_words:]
+        current.extend(words)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+def bm25_scores(query, chunks, k1=1.5, b=0.75):
+    """Okapi BM25 score of every chunk for the query."""
+    documents = [Counter(tokenize(chunk)) for chunk in chunks]
+    if not documents:
+        return []
+    lengths = [sum(document.values()) for document in documents]
+    average = sum(lengths) / len(lengths) or 1
+    terms = set(tokenize(query))
+    frequency = {term: sum(1 for document in documents if term in document) for term in terms}
+    scores = []
+    for document, length in zip(documents, lengths):
+        score = 0.0
+        for term in terms:
+            tf = document.get(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(documents) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+        scores.append(score)
+    return scores
+
+async def embedding_scores(query, chunks, model):
+    """Cosine similarity of every chunk with the query, embedded in one batched request."""
+    import numpy as np
+    response = await ollama_client.generate_embeddings({"model": model, "input": [query] + chunks, "truncate": True})
+    if "embeddings" not in response:
+        raise ValueError(response.get("error", "No embeddings returned"))
+    vectors = np.asarray(response["embeddings"], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1
+    vectors /= norms[:, None]
+    return (vectors[1:] @ vectors[0]).tolist()
+
+async def select_passages(query, sources, budget=RETRIEVAL_TOKEN_BUDGET, embed_model=RETRIEVAL_EMBED_MODEL):
+    """
+    Replace the content of every source by its passages most relevant to the query.
+
+    All sources are chunked and ranked together, the best chunks are taken until the token
+    budget is spent and put back in document order within their source. Sources without a
+    selected chunk are dropped.
+
+    :param query: The search question.
+    :param sources: Scraped sources with a "content" key, in rank order.
+    :param budget: Estimated tokens of source text to keep.
+    :param embed_model: Embedding model used to rank the chunks, None uses BM25.
+    :return: The sources with the selected passages.
+    """
+    chunks = []  # (source index, chunk index, text)
+    for source_index, source in enumerate(sources):
+        for chunk_index, chunk in enumerate(chunk_text(source.get("content") or "")):
+            chunks.append((source_index, chunk_index, chunk))
+    if not chunks:
+        return sources
+    texts = [chunk for _, _, chunk in chunks]
+
+    scores = None
+    if embed_model:
+        try:
+            with stage(RETRIEVAL_SECONDS, "retrieval", scorer="embedding"):
+                scores = await embedding_scores(query, texts, embed_model)
+        except Exception as e:
+            logger.warning(f"Embedding chunks failed, ranking with BM25: {e}")
+    if scores is None:
+        with stage(RETRIEVAL_SECONDS, "retrieval", scorer="bm25"):
+            scores = bm25_scores(query, texts)
+
+    # Higher rank sources win ties, then earlier chunks
+    order = sorted(range(len(chunks)), key=lambda i: (-scores[i], chunks[i][0], chunks[i][1]))
+    selected, spent = [], 0
+    for i in order:
+        cost = estimate_tokens(texts[i])
+        if spent + cost > budget:
+            continue  # A smaller chunk further down may still fit
+        selected.append(i)
+        spent += cost
+
+    passages = {}
+    for i in sorted(selected, key=lambda i: (chunks[i][0], chunks[i][1])):
+        passages.setdefault(chunks[i][0], []).append(texts[i])
+    logger.debug(f"Selected {len(selected)} of {len(chunks)} chunks ({spent} tokens) for {query!r}")
+    return [
+        {**source, "content": "\n...\n".join(passages[index])}
+        for index, source in enumerate(sources)
+        if index in passages
+    ]
@@ -0,0 +1,80 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+from app.metrics import current_timings, record_timing
+
+logger = logging.getLogger(__name__)
+
+flights = {}  # name -> SingleFlight, for the stats endpoint
+
+def payload_key(*parts):
+    """Canonical hash of a request payload: equal payloads give equal keys whatever their key order."""
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in flight, later callers
+    wait for it and share its result (or exception) instead of starting their own.
+    Results are shared between callers, they must not be modified. The stages timed by the
+    call are added to the timing breakdown of every caller's Siri task.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+        flights[name] = self
+
+    async def do(self, key, func, *args, **kwargs):
+        call = self.calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            logger.debug(f"{self.name}: joined in-flight call {key[:12]}")
+        else:
+            self.executed += 1
+            # Run the call in its own task so that a caller going away does not cancel it for the others
+            timings = {}
+            call = asyncio.ensure_future(self._call(timings, func, *args, **kwargs)), timings
+            self.calls[key] = call
+            call[0].add_done_callback(lambda _: self.calls.pop(key, None))
+        task, timings = call
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done():
+                for name, seconds in timings.items():
+                    for value in seconds if isinstance(seconds, list) else [seconds]:
+                        record_timing(name, value)
+
+    @staticmethod
+    async def _call(timings, func, *args, **kwargs):
+        # The task would otherwise time its stages into the first caller's breakdown only
+        current_timings.set(timings)
+        return await func(*args, **kwargs)
+
+    def stats(self):
+        return {"executed": self.executed, "coalesced": self.coalesced, "in_flight": len(self.calls)}
+
+def coalesce(name, key=None):
+    """
+    Decorator applying single-flight coalescing to a coroutine function.
+    key(*args, **kwargs) builds the coalescing key, by default every argument is hashed.
+    """
+    def decorator(func):
+        flight = SingleFlight(name)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call_key = key(*args, **kwargs) if key else payload_key(args, kwargs)
+            return await flight.do(call_key, func, *args, **kwargs)
+
+        wrapper.flight = flight
+        return wrapper
+    return decorator
+
+def singleflight_stats():
+    return {name: flight.stats() for name, flight in flights.items()}
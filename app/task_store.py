@@ -0,0 +1,284 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TASK_STORE_PATH = "./tasks.db"  # Shared by every uvicorn worker, set to None to keep tasks in this process only
+TASK_LEASE = 30  # Seconds without a heartbeat before a running task is given to another worker
+TASK_MAX_ATTEMPTS = 3  # Times a task is started before it is failed, when its workers keep dying
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+LOST_RESULT = {"error": "Task worker stopped responding"}
+CANCELLED_RESULT = {"error": "Task cancelled"}
+
+class MemoryTaskStore:
+    """
+    Task state kept in this process.
+
+    Every store has the same methods: the TaskManager calls them from worker threads, so they
+    are blocking and thread safe. Task records are plain dicts with the task_id, type, pool,
+    priority, status, data, result, timings and the wall clock times of its state changes.
+    """
+
+    def __init__(self):
+        self.records = {}  # task_id -> record
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def add(self, task_id, task_type, pool, data, priority=0):
+        with self._lock:
+            self._seq += 1
+            self.records[task_id] = {
+                "task_id": task_id, "type": task_type, "pool": pool, "priority": priority, "seq": self._seq,
+                "status": "scheduled", "data": data, "result": None, "timings": {}, "queued_at": time.time(),
+                "owner": None, "heartbeat_at": None, "finished_at": None, "attempts": 0,
+            }
+
+    def waiting(self, pool):
+        """Number of tasks of a pool not started yet."""
+        with self._lock:
+            return sum(1 for r in self.records.values() if r["pool"] == pool and r["status"] == "scheduled")
+
+    def _claimable(self, record, pool, expiry, max_attempts):
+        if record["pool"] != pool:
+            return False
+        if record["status"] == "scheduled":
+            return True
+        return record["status"] == "running" and record["heartbeat_at"] < expiry and record["attempts"] < max_attempts
+
+    def claim(self, pool, owner, lease=TASK_LEASE, max_attempts=TASK_MAX_ATTEMPTS):
+        """
+        Hand the next task of a pool to a worker: the highest priority waiting task, or a running
+        task whose worker has not sent a heartbeat within the lease. Returns its record or None.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [r for r in self.records.values() if self._claimable(r, pool, now - lease, max_attempts)]
+            if not candidates:
+                return None
+            record = min(candidates, key=lambda r: (-r["priority"], r["seq"]))
+            record.update(status="running", owner=owner, heartbeat_at=now, attempts=record["attempts"] + 1)
+            return dict(record)
+
+    def heartbeat(self, task_id, owner):
+        """Extend the lease of a running task. Returns False when the task is no longer this worker's."""
+        with self._lock:
+            record = self.records.get(task_id)
+            if record is None or record["status"] != "running" or record["owner"] != owner:
+                return False
+            record["heartbeat_at"] = time.time()
+            return True
+
+    def finish(self, task_id, owner, status, result, timings):
+        """Store the outcome of a task run by `owner`. Returns the task, which may have been cancelled meanwhile."""
+        with self._lock:
+            record = self.records.get(task_id)
+            if record is None:
+                return None
+            if record["status"] == "running" and record["owner"] == owner:
+                record.update(status=status, result=result, timings=timings, finished_at=time.time())
+            return self._task(record)
+
+    def release(self, task_id, owner):
+        """Put a task back in the queue, for a worker shutting down before it finished."""
+        with self._lock:
+            record = self.records.get(task_id)
+            if record is not None and record["status"] == "running" and record["owner"] == owner:
+                record.update(status="scheduled", owner=None, heartbeat_at=None, attempts=record["attempts"] - 1)
+
+    def cancel(self, task_id):
+        """Cancel a waiting or running task. Returns (status before, task), or None if it is unknown."""
+        with self._lock:
+            record = self.records.get(task_id)
+            if record is None:
+                return None
+            previous = record["status"]
+            if previous not in FINISHED_STATUSES:
+                record.update(status="cancelled", result=CANCELLED_RESULT, finished_at=time.time())
+            return previous, self._task(record)
+
+    def get(self, task_id):
+        with self._lock:
+            record = self.records.get(task_id)
+            return self._task(record) if record is not None else None
+
+    def prune(self, ttl, max_finished, lease=TASK_LEASE, max_attempts=TASK_MAX_ATTEMPTS):
+        """Fail tasks out of attempts, then forget finished tasks older than the TTL or beyond the maximum count."""
+        now = time.time()
+        with self._lock:
+            for record in self.records.values():
+                if record["status"] == "running" and record["heartbeat_at"] < now - lease and record["attempts"] >= max_attempts:
+                    record.update(status="failed", result=LOST_RESULT, finished_at=now)
+            finished = sorted((r for r in self.records.values() if r["status"] in FINISHED_STATUSES),
+                              key=lambda r: r["finished_at"], reverse=True)
+            expired = [r["task_id"] for i, r in enumerate(finished) if i >= max_finished or r["finished_at"] <= now - ttl]
+            for task_id in expired:
+                del self.records[task_id]
+            return len(expired)
+
+    def counts(self):
+        """Number of tasks per (pool, status)."""
+        counts = {}
+        with self._lock:
+            for record in self.records.values():
+                key = (record["pool"], record["status"])
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    @staticmethod
+    def _task(record):
+        return {key: record[key] for key in ("type", "data", "status", "result", "timings")}
+
+    def close(self):
+        pass
+
+class SQLiteTaskStore(MemoryTaskStore):
+    """
+    Task state in a SQLite database in WAL mode, shared by every process opening the same file.
+
+    Workers of any process claim tasks with a compare-and-set UPDATE, so a task is only started
+    once, and the state survives restarts: waiting tasks are run by the next worker to start,
+    running tasks of a dead worker are run again once their lease expires.
+    """
+
+    COLUMNS = ("task_id", "type", "pool", "priority", "status", "data", "result", "timings", "queued_at",
+               "owner", "heartbeat_at", "finished_at", "attempts")
+    JSON_COLUMNS = ("data", "result", "timings")
+
+    def __init__(self, path=TASK_STORE_PATH):
+        # Autocommit: every statement is its own transaction, the busy timeout covers other processes writing
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, task_id TEXT NOT NULL UNIQUE, type TEXT NOT NULL, "
+            "pool TEXT NOT NULL, priority INTEGER NOT NULL, status TEXT NOT NULL, data TEXT NOT NULL, result TEXT, "
+            "timings TEXT NOT NULL, queued_at REAL NOT NULL, owner TEXT, heartbeat_at REAL, finished_at REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_tasks_claim ON tasks (pool, status, priority DESC, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_tasks_finished ON tasks (status, finished_at)")
+        logger.info(f"Task store opened at {path}")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def _row(self, row):
+        record = dict(zip(self.COLUMNS, row))
+        for column in self.JSON_COLUMNS:
+            record[column] = json.loads(record[column]) if record[column] is not None else None
+        return record
+
+    def _select(self, where, params=(), suffix=""):
+        with self._lock:
+            rows = self._db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM tasks WHERE {where} {suffix}", params).fetchall()
+        return [self._row(row) for row in rows]
+
+    def add(self, task_id, task_type, pool, data, priority=0):
+        self._execute(
+            "INSERT INTO tasks (task_id, type, pool, priority, status, data, timings, queued_at) "
+            "VALUES (?, ?, ?, ?, 'scheduled', ?, '{}', ?)",
+            (task_id, task_type, pool, priority, json.dumps(data), time.time()),
+        )
+
+    def waiting(self, pool):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM tasks WHERE pool = ? AND status = 'scheduled'", (pool,)).fetchone()[0]
+
+    def claim(self, pool, owner, lease=TASK_LEASE, max_attempts=TASK_MAX_ATTEMPTS):
+        while True:
+            now = time.time()
+            # Read the candidate without taking the write lock, idle workers poll this
+            candidates = self._select(
+                "pool = ? AND (status = 'scheduled' OR (status = 'running' AND heartbeat_at < ? AND attempts < ?))",
+                (pool, now - lease, max_attempts), "ORDER BY status = 'running', priority DESC, id LIMIT 1",
+            )
+            if not candidates:
+                return None
+            record = candidates[0]
+            # Only one worker wins the update, a loser sees the row changed and tries the next task
+            claimed = self._execute(
+                "UPDATE tasks SET status = 'running', owner = ?, heartbeat_at = ?, attempts = attempts + 1 "
+                "WHERE task_id = ? AND status = ? AND owner IS ? AND attempts = ?",
+                (owner, now, record["task_id"], record["status"], record["owner"], record["attempts"]),
+            ).rowcount
+            if claimed:
+                if record["status"] == "running":
+                    logger.warning(f"Task {record['task_id']} lost its worker, running it again")
+                record.update(status="running", owner=owner, heartbeat_at=now, attempts=record["attempts"] + 1)
+                return record
+
+    def heartbeat(self, task_id, owner):
+        return self._execute(
+            "UPDATE tasks SET heartbeat_at = ? WHERE task_id = ? AND status = 'running' AND owner = ?",
+            (time.time(), task_id, owner),
+        ).rowcount == 1
+
+    def finish(self, task_id, owner, status, result, timings):
+        self._execute(
+            "UPDATE tasks SET status = ?, result = ?, timings = ?, finished_at = ? "
+            "WHERE task_id = ? AND status = 'running' AND owner = ?",
+            (status, json.dumps(result), json.dumps(timings), time.time(), task_id, owner),
+        )
+        return self.get(task_id)
+
+    def release(self, task_id, owner):
+        self._execute(
+            "UPDATE tasks SET status = 'scheduled', owner = NULL, heartbeat_at = NULL, attempts = attempts - 1 "
+            "WHERE task_id = ? AND status = 'running' AND owner = ?",
+            (task_id, owner),
+        )
+
+    def cancel(self, task_id):
+        task = self.get(task_id)
+        if task is None:
+            return None
+        if task["status"] not in FINISHED_STATUSES:
+            cancelled = self._execute(
+                "UPDATE tasks SET status = 'cancelled', result = ?, finished_at = ? WHERE task_id = ? AND status = ?",
+                (json.dumps(CANCELLED_RESULT), time.time(), task_id, task["status"]),
+            ).rowcount
+            if not cancelled:
+                return self.cancel(task_id)  # Claimed or finished in the meantime
+        return task["status"], self.get(task_id)
+
+    def get(self, task_id):
+        records = self._select("task_id = ?", (task_id,))
+        return self._task(records[0]) if records else None
+
+    def prune(self, ttl, max_finished, lease=TASK_LEASE, max_attempts=TASK_MAX_ATTEMPTS):
+        now = time.time()
+        placeholders = ", ".join("?" * len(FINISHED_STATUSES))
+        self._execute(
+            "UPDATE tasks SET status = 'failed', result = ?, finished_at = ? "
+            "WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+            (json.dumps(LOST_RESULT), now, now - lease, max_attempts),
+        )
+        removed = self._execute(
+            f"DELETE FROM tasks WHERE status IN ({placeholders}) AND finished_at <= ?", (*FINISHED_STATUSES, now - ttl)
+        ).rowcount
+        removed += self._execute(
+            f"DELETE FROM tasks WHERE id IN (SELECT id FROM tasks WHERE status IN ({placeholders}) "
+            f"ORDER BY finished_at DESC LIMIT -1 OFFSET ?)", (*FINISHED_STATUSES, max_finished)
+        ).rowcount
+        return removed
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute("SELECT pool, status, COUNT(*) FROM tasks GROUP BY pool, status").fetchall()
+        return {(pool, status): count for pool, status, count in rows}
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+            self._db = None
+
+def open_task_store(path=TASK_STORE_PATH):
+    """The SQLite store at `path`, or a store local to this process when path is None."""
+    return SQLiteTaskStore(path) if path else MemoryTaskStore()
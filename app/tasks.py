@@ -1,86 +1,389 @@
-import asyncio
-import aiohttp
-import logging
-from app.ollama_client import OllamaClient
-from app.functions_endpoint import scrape_clean_text, search_xng
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,  # Set to DEBUG to capture all levels of logs
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-class TaskManager:
-    def __init__(self):
-        self.tasks = {}
-        self.ollama_client = OllamaClient()
-        logging.debug("TaskManager initialized")
-
-    def add_task(self, task_id, task_type, data):
-        self.tasks[task_id] = {"type": task_type, "data": data, "status": "scheduled", "result": None}
-        asyncio.create_task(self.execute_task(task_id))
-        logging.debug(f"Task {task_id} added with type {task_type}")
-
-    async def execute_task(self, task_id):
-        task = self.tasks[task_id]
-        task["status"] = "running"
-        logging.debug(f"Task {task_id} started")
-        try:
-            async with aiohttp.ClientSession() as session:
-                if task["type"] == "summarize_url":
-                    scraped_data = await scrape_clean_text(task["data"]["url"], session=session)
-                    if scraped_data:
-                        cleaned_html = scraped_data["cleaned_html"]
-                        original_message = task["data"]["messages"][0]
-                        original_message["content"] = original_message["content"] + "\n" + cleaned_html
-                        request_data = {
-                            "model": task["data"]["model"],
-                            "messages": [original_message],
-                            "stream": task["data"]["stream"]
-                        }
-                        if "options" in task["data"]:
-                            request_data["options"] = task["data"]["options"]
-                        if "images" in task["data"]:
-                            request_data["images"] = task["data"]["images"]
-                        result = await self.ollama_client.generate_chat(request_data)
-                        task["status"] = "done"
-                        task["result"] = result
-                        logging.debug(f"Task {task_id} completed successfully with result: {result}")
-                    else:
-                        task["status"] = "failed"
-                        task["result"] = {"error": "Failed to scrape URL"}
-                        logging.error(f"Task {task_id} failed with error: Failed to scrape URL")
-
-                elif task["type"] == "search_web":
-                    search_result = await search_xng(task["data"]["searchQ"], session=session)
-                    if search_result:
-                        request_data = {
-                            "model": task["data"]["model"],
-                            "messages": [{"role":"user","content":search_result}],
-                            "stream": task["data"]["stream"],
-                            "options": {"num_ctx":8192}
-                        }
-                        result = await self.ollama_client.generate_chat(request_data)
-                        task["status"] = "done"
-                        task["result"] = result
-                        logging.debug(f"Task {task_id} completed successfully with result: {result}")
-
-                elif task["type"] == "embed":
-                    result = await self.ollama_client.generate_embeddings(task["data"])
-                else:
-                    result = {"error": "Unknown task type"}
-                task["status"] = "done"
-                task["result"] = result
-                logging.info(f"Task {task_id} completed successfully with result: {result}")
-        except Exception as e:
-            task["status"] = "failed"
-            task["result"] = {"error": str(e)}
-            logging.error(f"Task {task_id} failed with error: {e}")
-
-    def get_task_status(self, task_id):
-        if task_id in self.tasks:
-            logging.debug(f"Task {task_id} status requested: {self.tasks[task_id]['status']}")
-            return self.tasks[task_id]
-        else:
-            logging.warning(f"Task {task_id} not found")
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from app.http_client import get_session
+from app.ollama_client import ollama_client, merge_chat_chunks
+from app.functions_endpoint import scrape_clean_text, search_xng, SEARCH_NUM_CTX
+from app.metrics import current_timings, TASK_QUEUE_WAIT_SECONDS, TASK_SECONDS, TASKS, TASKS_REJECTED
+from app.task_store import open_task_store, FINISHED_STATUSES, TASK_STORE_PATH
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,  # Set to DEBUG to capture all levels of logs
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# Worker pool settings
+TASK_WORKERS = {  # Number of workers per task type, other types share the "default" pool
+    "summarize_url": 2,
+    "search_web": 2,
+    "embed": 4,
+    "default": 1,
+}
+TASK_QUEUE_SIZE = 100  # Maximum number of waiting tasks per task type
+TASK_TTL = 60 * 60  # Seconds a finished task is kept for status requests
+TASK_MAX_FINISHED = 1000  # Maximum number of finished tasks kept
+TASK_MAX_WAIT = 60  # Maximum seconds a status request may wait for a task to finish
+TASK_POLL_INTERVAL = 0.5  # Seconds between checks of the task store for work and status changes from other processes
+TASK_HEARTBEAT_INTERVAL = 5  # Seconds between lease renewals of a running task, a cancel from another process is seen as fast
+TASK_PRUNE_INTERVAL = 60  # Seconds between removals of expired tasks from the store
+TASK_COUNT_INTERVAL = 5  # Seconds between refreshes of the queue depths reported on /metrics
+
+class QueueFullError(Exception):
+    """Raised by TaskManager.add_task when the queue for a task type is full."""
+
+class TaskManager:
+    """
+    Runs Siri tasks on a fixed number of workers per task type.
+
+    Task state lives in a task store (app/task_store.py), by default a SQLite database shared
+    by every uvicorn worker process: a task can be queued by one process, claimed by a worker
+    of another, and its status read, awaited or cancelled from any of them. Tasks running in
+    this process are also kept in self.tasks for their live state.
+    """
+
+    def __init__(self, workers=TASK_WORKERS, queue_size=TASK_QUEUE_SIZE, ttl=TASK_TTL, max_finished=TASK_MAX_FINISHED,
+                 answer_cache=None, embedder=None, store=None, store_path=TASK_STORE_PATH):
+        self.tasks = {}  # task_id -> state of the tasks executed by this process
+        self.ollama_client = ollama_client
+        self.answer_cache = answer_cache  # Semantic cache of search_web answers, used when enabled
+        self.embedder = embedder or ollama_client  # Anything with generate_embeddings(), e.g. an EmbeddingBatcher
+        self.workers_per_type = {"default": 1, **workers}
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.store = store  # Opened by start() when not given
+        self.store_path = store_path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"  # Identifies this process' claims
+        self.wakeups = {}  # pool -> queue waking its workers when this process adds a task
+        self.workers = []
+        self.running = {}  # task_id -> asyncio.Task executing it
+        self.subscribers = {}  # task_id -> queues receiving the task's status and token events
+        self.partial = {}  # task_id -> reply streamed so far, sent to subscribers joining late
+        self._pruned_at = 0
+        self.counts = {}  # (pool, status) -> number of tasks in the store, refreshed by the workers
+        self._counted_at = 0
+        logging.debug("TaskManager initialized")
+
+    async def start(self):
+        """Open the task store and start the workers of every pool, tasks may be waiting from before a restart."""
+        if self.store is None:
+            self.store = await asyncio.to_thread(open_task_store, self.store_path)
+        for pool, count in self.workers_per_type.items():
+            self.wakeups[pool] = asyncio.Queue()
+            for _ in range(count):
+                self.workers.append(asyncio.create_task(self._worker(pool)))
+        logging.debug(f"Started {len(self.workers)} task workers as {self.owner}")
+
+    def _pool(self, task_type):
+        return task_type if task_type in self.workers_per_type else "default"
+
+    async def add_task(self, task_id, task_type, data, priority=0):
+        """
+        Queue a task. Tasks with a higher priority are started first.
+        Raises QueueFullError when too many tasks of this type are waiting.
+        """
+        await self._prune()
+        pool = self._pool(task_type)
+        if await asyncio.to_thread(self.store.waiting, pool) >= self.queue_size:
+            TASKS_REJECTED.inc(type=task_type)
+            raise QueueFullError(f"Too many {task_type} tasks waiting, try again later")
+        await asyncio.to_thread(self.store.add, task_id, task_type, pool, data, priority)
+        self.wakeups[pool].put_nowait(None)
+        logging.debug(f"Task {task_id} added with type {task_type}")
+
+    async def _worker(self, pool):
+        wakeup = self.wakeups[pool]
+        while True:
+            try:
+                await self._count()
+                record = await asyncio.to_thread(self.store.claim, pool, self.owner)
+                if record is not None:
+                    await self._run(record)
+                    continue
+                await self._prune()
+            except Exception as e:
+                # The store may be busy or unreachable for a while, the worker keeps going
+                logging.error(f"Task worker for {pool} tasks failed: {e}")
+            # Tasks added here wake the worker at once, tasks added by other processes are found by polling
+            try:
+                await asyncio.wait_for(wakeup.get(), TASK_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, record):
+        task_id = record["task_id"]
+        task = {"type": record["type"], "data": record["data"], "status": "scheduled", "result": None,
+                "timings": record["timings"] or {}}
+        self.tasks[task_id] = task
+        started = time.monotonic()
+        queue_wait = max(time.time() - record["queued_at"], 0)
+        TASK_QUEUE_WAIT_SECONDS.observe(queue_wait, type=task["type"])
+        task["timings"]["queue_wait"] = round(queue_wait, 4)
+        runner = asyncio.create_task(self.execute_task(task_id))
+        self.running[task_id] = runner
+        try:
+            while not runner.done():
+                await asyncio.wait([runner], timeout=TASK_HEARTBEAT_INTERVAL)
+                if not runner.done() and not await asyncio.to_thread(self.store.heartbeat, task_id, self.owner):
+                    # Cancelled from another process, or the lease was lost and another worker runs it
+                    runner.cancel()
+                    await asyncio.wait([runner])
+            TASK_SECONDS.observe(time.monotonic() - started, type=task["type"])
+            task["timings"]["total"] = round(queue_wait + time.monotonic() - started, 4)
+            stored = await asyncio.to_thread(self.store.finish, task_id, self.owner, task["status"], task["result"], task["timings"])
+        except asyncio.CancelledError:
+            # Shutting down: the task goes back to the queue for the next worker to start
+            runner.cancel()
+            await asyncio.to_thread(self.store.release, task_id, self.owner)
+            raise
+        finally:
+            self.running.pop(task_id, None)
+            self.tasks.pop(task_id, None)
+        if stored is not None and stored["status"] in FINISHED_STATUSES:
+            self._finish(task_id, stored)
+        else:
+            self.partial.pop(task_id, None)
+
+    def _finish(self, task_id, task):
+        TASKS.inc(type=task["type"], status=task["status"])
+        self._publish(task_id, "status", {"status": task["status"], "result": task["result"]})
+        self.partial.pop(task_id, None)
+
+    def _publish(self, task_id, event, data):
+        for queue in self.subscribers.get(task_id, ()):
+            queue.put_nowait((event, data))
+
+    async def get_task(self, task_id):
+        """The state of a task, None if it is unknown. Tasks running here are read live, others from the store."""
+        task = self.tasks.get(task_id)
+        if task is None and self.store is not None:
+            task = await asyncio.to_thread(self.store.get, task_id)
+        return task
+
+    async def wait_for_task(self, task_id, timeout):
+        """Wait until a task is finished or the timeout (in seconds) expires, whichever process runs it."""
+        async def finished():
+            async for _ in self.task_events(task_id, keepalive=None):
+                pass
+        try:
+            await asyncio.wait_for(finished(), min(timeout, TASK_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+
+    async def task_events(self, task_id, keepalive=15):
+        """
+        Yield (event, data) pairs for a task: its current status, then "token" events with the
+        reply as it is generated and "status" events on every change, up to the final status.
+        A ("keepalive", None) pair is yielded after `keepalive` seconds without events.
+
+        Tasks queued or running in another process are followed through the store: their status
+        changes are seen within the poll interval, their reply comes with the final status only.
+        """
+        task = await self.get_task(task_id)
+        if task is None:
+            return
+        if task["status"] in FINISHED_STATUSES:
+            yield "status", {"status": task["status"], "result": task["result"]}
+            return
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(task_id, set()).add(queue)
+        try:
+            status = task["status"]
+            yield "status", {"status": status}
+            if self.partial.get(task_id):
+                yield "token", {"content": self.partial[task_id]}
+            idle = 0
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), TASK_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    event, data = None, None
+                    if task_id not in self.running:
+                        task = await asyncio.to_thread(self.store.get, task_id)
+                        if task is None:
+                            return  # Expired
+                        if task["status"] != status:
+                            event, data = "status", {"status": task["status"]}
+                            if task["status"] in FINISHED_STATUSES:
+                                data["result"] = task["result"]
+                if event == "closed":
+                    return
+                if event is None or (event == "status" and data["status"] == status):
+                    idle += TASK_POLL_INTERVAL
+                    if keepalive is not None and idle >= keepalive:
+                        idle = 0
+                        yield "keepalive", None
+                    continue
+                idle = 0
+                if event == "status":
+                    status = data["status"]
+                yield event, data
+                if event == "status" and status in FINISHED_STATUSES:
+                    return
+        finally:
+            queue_set = self.subscribers.get(task_id)
+            if queue_set is not None:
+                queue_set.discard(queue)
+                if not queue_set:
+                    del self.subscribers[task_id]
+
+    async def _cached_answer(self, task, use_cache):
+        """
+        Look up the answer to a search_web question in the semantic answer cache.
+        Returns (question vector, answer), the vector is None when the cache is not used.
+        """
+        if self.answer_cache is None or not self.answer_cache.enabled or not use_cache:
+            return None, None
+        try:
+            return await self.answer_cache.lookup(task["data"]["searchQ"], task["data"]["model"])
+        except Exception as e:
+            # The cache is an optimization, the question is still answered without it
+            logging.warning(f"Answer cache lookup failed: {e}")
+            return None, None
+
+    async def _chat(self, task_id, request_data):
+        """Run a chat completion, streaming the reply to the task's subscribers when stream is set."""
+        if not request_data.get("stream"):
+            return await self.ollama_client.generate_chat(request_data)
+        chunks = []
+        self.partial[task_id] = ""
+        async for line in self.ollama_client.stream_chat(request_data):
+            chunk = json.loads(line)
+            chunks.append(chunk)
+            content = chunk.get("message", {}).get("content")
+            if content:
+                self.partial[task_id] += content
+                self._publish(task_id, "token", {"content": content})
+        return merge_chat_chunks(chunks)
+
+    async def _prune(self):
+        """Forget finished tasks older than the TTL or beyond the maximum count, once per prune interval."""
+        if time.monotonic() - self._pruned_at < TASK_PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        removed = await asyncio.to_thread(self.store.prune, self.ttl, self.max_finished)
+        if removed:
+            logging.debug(f"Removed {removed} expired tasks")
+
+    async def _count(self):
+        """Refresh the task counts read by queue_depths(), once per count interval."""
+        if time.monotonic() - self._counted_at < TASK_COUNT_INTERVAL:
+            return
+        self._counted_at = time.monotonic()
+        self.counts = await asyncio.to_thread(self.store.counts)
+
+    async def cancel_task(self, task_id):
+        """Cancel a waiting or running task. Returns the task, or None if it is unknown."""
+        outcome = await asyncio.to_thread(self.store.cancel, task_id)
+        if outcome is None:
+            return None
+        previous, task = outcome
+        runner = self.running.get(task_id)
+        if runner is not None:
+            runner.cancel()  # Its worker publishes the final status
+        elif previous == "scheduled":
+            self._finish(task_id, task)
+        # Running in another process: its worker sees the cancel on its next heartbeat
+        logging.debug(f"Task {task_id} cancelled")
+        return task
+
+    def queue_depths(self):
+        """
+        Number of tasks waiting per pool, across every process sharing the store.
+        Read from the counts last refreshed by the workers, /metrics does not query the store.
+        """
+        return {pool: self.counts.get((pool, "scheduled"), 0) for pool in self.workers_per_type}
+
+    async def stop(self):
+        """Stop the workers, the tasks they are running are put back in the queue."""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for queues in self.subscribers.values():
+            for queue in queues:
+                queue.put_nowait(("closed", None))
+        self.workers = []
+        self.running = {}
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    async def execute_task(self, task_id):
+        task = self.tasks[task_id]
+        task["status"] = "running"
+        self._publish(task_id, "status", {"status": "running"})
+        # Stages timed below (search, scrapes, Ollama) add their durations to this task's breakdown
+        current_timings.set(task.setdefault("timings", {}))
+        logging.debug(f"Task {task_id} started")
+        try:
+            session = get_session()
+            if task["type"] == "summarize_url":
+                scraped_data = await scrape_clean_text(task["data"]["url"], session=session, use_cache=not task["data"].get("no_cache"))
+                if scraped_data:
+                    cleaned_html = scraped_data["cleaned_html"]
+                    original_message = task["data"]["messages"][0]
+                    original_message["content"] = original_message["content"] + "\n" + cleaned_html
+                    request_data = {
+                        "model": task["data"]["model"],
+                        "messages": [original_message],
+                        "stream": task["data"]["stream"]
+                    }
+                    if "options" in task["data"]:
+                        request_data["options"] = task["data"]["options"]
+                    if "images" in task["data"]:
+                        request_data["images"] = task["data"]["images"]
+                    result = await self._chat(task_id, request_data)
+                    task["status"] = "done"
+                    task["result"] = result
+                    logging.debug(f"Task {task_id} completed successfully with result: {result}")
+                else:
+                    task["status"] = "failed"
+                    task["result"] = {"error": "Failed to scrape URL"}
+                    logging.error(f"Task {task_id} failed with error: Failed to scrape URL")
+
+            elif task["type"] == "search_web":
+                use_cache = not task["data"].get("no_cache")
+                question_vector, result = await self._cached_answer(task, use_cache)
+                search_result = None
+                if result is None:
+                    search_result = await search_xng(task["data"]["searchQ"], session=session, use_cache=use_cache)
+                if search_result:
+                    request_data = {
+                        "model": task["data"]["model"],
+                        "messages": [{"role":"user","content":search_result}],
+                        "stream": task["data"]["stream"],
+                        "options": {"num_ctx": SEARCH_NUM_CTX}
+                    }
+                    result = await self._chat(task_id, request_data)
+                    task["status"] = "done"
+                    task["result"] = result
+                    logging.debug(f"Task {task_id} completed successfully with result: {result}")
+                    if question_vector is not None and "error" not in result:
+                        await self.answer_cache.store(question_vector, task["data"]["searchQ"], task["data"]["model"], result)
+
+            elif task["type"] == "embed":
+                result = await self.embedder.generate_embeddings(task["data"])
+            else:
+                result = {"error": "Unknown task type"}
+            task["status"] = "done"
+            task["result"] = result
+            logging.info(f"Task {task_id} completed successfully")
+            logging.debug(f"Task {task_id} result: {result}")
+        except Exception as e:
+            task["status"] = "failed"
+            task["result"] = {"error": str(e)}
+            logging.error(f"Task {task_id} failed with error: {e}")
+
+    async def get_task_status(self, task_id):
+        task = await self.get_task(task_id)
+        if task is not None:
+            logging.debug(f"Task {task_id} status requested: {task['status']}")
+            return task
+        else:
+            logging.warning(f"Task {task_id} not found")
             return {"error": "Task not found"}
\ No newline at end of file
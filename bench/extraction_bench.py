@@ -0,0 +1,91 @@
+"""
+Microbenchmark of the HTML extraction backends in app/extraction.py.
+
+Every backend runs on the same generated corpus, first inline (CPU time per page) and then
+through the process pool used by the server (pages per second). Results are printed as JSON.
+
+    python -m bench.extraction_bench --pages 200 --workers 2
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from app import extraction
+
+WORDS = ("llama model token context search answer source page news weather music city "
+         "science history market energy health travel sport recipe garden").split()
+
+def make_page(rng, paragraphs):
+    """A news-like page: navigation, scripts and styles around an article."""
+    def sentence():
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + "."
+    nav = "".join(f"<li><a href='/section/{i}'>{rng.choice(WORDS)}</a></li>" for i in range(30))
+    body = "".join(f"<p>{' '.join(sentence() for _ in range(rng.randint(2, 6)))}</p>" for _ in range(paragraphs))
+    script = "<script>var data = " + json.dumps([rng.random() for _ in range(200)]) + ";</script>"
+    return (
+        "<!DOCTYPE html><html><head><title>" + sentence() + "</title>"
+        "<link rel='shortcut icon' href='/static/favicon.ico'><style>body{font-family:sans-serif}</style>"
+        + script + "</head><body><header><nav><ul>" + nav + "</ul></nav></header>"
+        "<main><article><h1>" + sentence() + "</h1>" + body + "</article></main>"
+        "<aside>" + sentence() + "</aside><footer>" + sentence() + "</footer></body></html>"
+    )
+
+def make_corpus(pages, seed=1234):
+    rng = random.Random(seed)
+    # Mostly short pages with a tail of very long ones, like real search results
+    return [make_page(rng, rng.choice((5, 10, 20, 40, 200))) for _ in range(pages)]
+
+def bench_inline(extractor, corpus):
+    timings = []
+    for html in corpus:
+        started = time.process_time()
+        try:
+            extractor(html, "https://example.com/article")
+        except ValueError:
+            pass  # trafilatura finds no content on some pages
+        timings.append((time.process_time() - started) * 1000)
+    timings.sort()
+    return {
+        "cpu_ms_mean": round(sum(timings) / len(timings), 3),
+        "cpu_ms_p50": round(timings[len(timings) // 2], 3),
+        "cpu_ms_p95": round(timings[int(len(timings) * 0.95)], 3),
+    }
+
+async def bench_pool(kind, corpus):
+    async def run(html):
+        try:
+            await extraction.extract_page(kind, html, "https://example.com/article")
+        except ValueError:
+            pass
+    started = time.perf_counter()
+    await asyncio.gather(*(run(html) for html in corpus))
+    elapsed = time.perf_counter() - started
+    return {"pool_pages_per_s": round(len(corpus) / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=extraction.EXTRACTION_WORKERS)
+    parser.add_argument("--backends", nargs="*", default=list(extraction.EXTRACTORS))
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.pages)
+    results = {
+        "pages": args.pages,
+        "corpus_bytes": sum(len(html) for html in corpus),
+        "workers": args.workers,
+        "backends": {},
+    }
+    extraction.start_extraction_pool(args.workers)
+    try:
+        for kind in args.backends:
+            result = bench_inline(extraction.EXTRACTORS[kind], corpus)
+            result.update(asyncio.run(bench_pool(kind, corpus)))
+            results["backends"][kind] = result
+    finally:
+        extraction.stop_extraction_pool()
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Local stand-ins for the services siriLLama talks to, used by the load benchmark.
+
+- Ollama: /api/tags, /api/ps, /api/chat (streamed or not), /api/embed and /api/generate,
+  on one or more nodes
+- SearXNG: /search, returning links to the fake web server
+- Web: /page/{id}, generated article pages of a configurable size
+
+Latencies and payload sizes are configurable so that runs are reproducible and independent
+of a real model or network.
+"""
+import asyncio
+import json
+import random
+from aiohttp import web
+from bench.extraction_bench import make_page
+
+class FakeUpstreams:
+    def __init__(self, latency=0.05, tokens=32, token_delay=0.005, embed_dim=768,
+                 results=5, page_paragraphs=20, web_latency=0.02, nodes=1, seed=1234):
+        """
+        :param latency: Seconds before Ollama answers (time to first token when streaming).
+        :param tokens: Chunks in a chat reply.
+        :param token_delay: Seconds between streamed chunks.
+        :param embed_dim: Length of the returned embedding vectors.
+        :param results: Results returned by a SearXNG query.
+        :param page_paragraphs: Paragraphs per generated web page.
+        :param web_latency: Seconds before SearXNG and the web server answer.
+        :param nodes: Number of fake Ollama servers.
+        """
+        self.latency = latency
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.embed_dim = embed_dim
+        self.results = results
+        self.web_latency = web_latency
+        self.nodes = nodes
+        rng = random.Random(seed)
+        self.pages = [make_page(rng, page_paragraphs) for _ in range(16)]
+        self.requests = {}
+        self._runners = []
+        self.urls = {}
+
+    def _count(self, name):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    async def tags(self, request):
+        self._count("ollama.tags")
+        return web.json_response({"models": [{"name": "bench", "model": "bench"}]})
+
+    async def ps(self, request):
+        self._count("ollama.ps")
+        return web.json_response({"models": [{"name": "bench", "model": "bench"}]})
+
+    async def chat(self, request):
+        self._count("ollama.chat")
+        body = await request.json()
+        model = body.get("model", "bench")
+        await asyncio.sleep(self.latency)
+        if not body.get("stream", True):
+            await asyncio.sleep(self.token_delay * self.tokens)
+            content = " ".join(["token"] * self.tokens)
+            return web.json_response({"model": model, "message": {"role": "assistant", "content": content}, "done": True})
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for _ in range(self.tokens):
+            chunk = {"model": model, "message": {"role": "assistant", "content": "token "}, "done": False}
+            await response.write((json.dumps(chunk) + "\n").encode())
+            await asyncio.sleep(self.token_delay)
+        done = {"model": model, "message": {"role": "assistant", "content": ""}, "done": True, "eval_count": self.tokens}
+        await response.write((json.dumps(done) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def generate(self, request):
+        self._count("ollama.generate")
+        body = await request.json()
+        await asyncio.sleep(self.latency + self.token_delay * self.tokens)
+        return web.json_response({"model": body.get("model", "bench"), "response": " ".join(["token"] * self.tokens), "done": True})
+
+    async def embed(self, request):
+        self._count("ollama.embed")
+        body = await request.json()
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        await asyncio.sleep(self.latency)
+        embeddings = []
+        for text in inputs:
+            rng = random.Random(text)
+            embeddings.append([rng.uniform(-1, 1) for _ in range(self.embed_dim)])
+        return web.json_response({"model": body.get("model", "bench"), "embeddings": embeddings})
+
+    async def search(self, request):
+        self._count("searxng")
+        query = request.query.get("q", "")
+        await asyncio.sleep(self.web_latency)
+        offset = sum(map(ord, query))
+        results = [
+            {"url": f"{self.urls['web']}/page/{offset + i}", "title": f"{query} {i}", "content": query}
+            for i in range(self.results)
+        ]
+        return web.json_response({"query": query, "results": results})
+
+    async def page(self, request):
+        self._count("web")
+        await asyncio.sleep(self.web_latency)
+        html = self.pages[int(request.match_info["id"]) % len(self.pages)]
+        return web.Response(text=html, content_type="text/html")
+
+    async def start(self, host="127.0.0.1"):
+        self.urls["ollama"] = []
+        for _ in range(self.nodes):
+            ollama = web.Application()
+            ollama.router.add_get("/api/tags", self.tags)
+            ollama.router.add_get("/api/ps", self.ps)
+            ollama.router.add_post("/api/chat", self.chat)
+            ollama.router.add_post("/api/embed", self.embed)
+            ollama.router.add_post("/api/generate", self.generate)
+            self.urls["ollama"].append(await self._serve(ollama, host))
+        searxng = web.Application()
+        searxng.router.add_get("/search", self.search)
+        self.urls["searxng"] = await self._serve(searxng, host)
+        site = web.Application()
+        site.router.add_get("/page/{id}", self.page)
+        self.urls["web"] = await self._serve(site, host)
+        return self.urls
+
+    async def _serve(self, app, host):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        tcp = web.TCPSite(runner, host, 0)
+        await tcp.start()
+        self._runners.append(runner)
+        port = tcp._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners = []
@@ -0,0 +1,252 @@
+"""
+Load test of the whole server against local stand-ins for Ollama, SearXNG and the web.
+
+The server (app.main:app) is started in a subprocess inside a temporary directory, so the
+database and caches start empty on every run, and pointed at the fake upstreams from
+bench/fake_upstreams.py. Each workload then sends a fixed number of requests with a fixed
+concurrency and reports latency percentiles, requests per second, errors and the peak RSS of
+the server. Results are printed as JSON to compare between commits.
+
+    python -m bench.load_bench --requests 200 --concurrency 16
+    python -m bench.load_bench --workloads chat chat_stream --ollama-latency 0.2 --output before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+from bench.fake_upstreams import FakeUpstreams
+
+WORKLOADS = ("chat", "chat_stream", "embed", "siri", "siri_wait", "searx")
+MODEL = "bench"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def serve(args):
+    """Run the server pointed at the fake upstreams (executed in the server subprocess)."""
+    import uvicorn
+    from app import main, functions_endpoint, ollama_client
+    ollama_client.ollama_client.backends = [ollama_client.Backend(url) for url in args.ollama_url]
+    functions_endpoint.SEARXNG_URL = f"{args.searxng_url}/search"
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return round(values[index] * 1000, 2)
+
+def peak_rss_mb(pid):
+    """Peak resident set size of a process (VmHWM), None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+class LoadClient:
+    def __init__(self, base_url, session, rng, distinct):
+        self.base_url = base_url
+        self.session = session
+        self.rng = rng
+        self.distinct = distinct  # Size of the pool requests are drawn from, repeats hit the caches
+
+    def text(self, prefix):
+        return f"{prefix} {self.rng.randrange(self.distinct)}"
+
+    async def chat(self, stream=False):
+        payload = {"model": MODEL, "messages": [{"role": "user", "content": self.text("question")}], "stream": stream}
+        started = time.perf_counter()
+        async with self.session.post(f"{self.base_url}/api/chat", json=payload) as response:
+            response.raise_for_status()
+            if not stream:
+                await response.json()
+                return None
+            first_chunk = None
+            async for line in response.content:
+                if first_chunk is None and line.strip():
+                    first_chunk = time.perf_counter() - started
+            return first_chunk
+
+    async def chat_stream(self):
+        return await self.chat(stream=True)
+
+    async def embed(self):
+        payload = {"model": MODEL, "input": [self.text("sentence") for _ in range(8)]}
+        async with self.session.post(f"{self.base_url}/api/embed", json=payload) as response:
+            response.raise_for_status()
+            await response.json()
+
+    async def siri(self, poll_interval=0.05, wait=0):
+        payload = {"type": "search_web", "model": MODEL, "messages": [], "searchQ": self.text("query")}
+        async with self.session.post(f"{self.base_url}/siri", json=payload) as response:
+            response.raise_for_status()
+            task_id = (await response.json())["task_id"]
+        while True:
+            if not wait:
+                await asyncio.sleep(poll_interval)
+            async with self.session.get(f"{self.base_url}/siri/status/{task_id}", params={"wait": wait}) as response:
+                status = await response.json()
+            if status.get("status") == "done":
+                return None
+            if status.get("status") in ("failed", "cancelled") or "error" in status:
+                raise RuntimeError(f"Task {task_id} {status.get('status')}: {status.get('result')}")
+
+    async def siri_wait(self):
+        # Same as siri, with long polling instead of a fixed poll interval
+        return await self.siri(wait=30)
+
+    async def searx(self):
+        payload = {"search_query": self.text("query")}
+        async with self.session.post(f"{self.base_url}/functions/searx", json=payload) as response:
+            response.raise_for_status()
+            await response.json()
+
+async def run_workload(client, name, requests, concurrency):
+    latencies, first_chunks, errors = [], [], {}
+    counter = iter(range(requests))
+    call = getattr(client, name)
+
+    async def worker():
+        for _ in counter:
+            started = time.perf_counter()
+            try:
+                first_chunk = await call()
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            if first_chunk is not None:
+                first_chunks.append(first_chunk)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "latency_ms": {f"p{pct}": percentile(latencies, pct) for pct in (50, 95, 99)},
+    }
+    if first_chunks:
+        result["first_chunk_ms"] = {f"p{pct}": percentile(first_chunks, pct) for pct in (50, 95, 99)}
+    return result
+
+async def wait_until_ready(base_url, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with code {server.returncode}")
+            try:
+                async with session.get(f"{base_url}/") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError("Server did not start")
+
+async def bench(args):
+    upstreams = FakeUpstreams(latency=args.ollama_latency, tokens=args.tokens, token_delay=args.token_delay,
+                              embed_dim=args.embed_dim, results=args.results,
+                              page_paragraphs=args.page_paragraphs, web_latency=args.web_latency,
+                              nodes=args.ollama_nodes)
+    urls = await upstreams.start()
+    base_url = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))))
+    with tempfile.TemporaryDirectory(prefix="sirillama-bench-") as workdir:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "bench.load_bench", "serve", "--port", str(args.port),
+             "--ollama-url", *urls["ollama"], "--searxng-url", urls["searxng"]],
+            cwd=workdir, env=env,
+        )
+        try:
+            await wait_until_ready(base_url, server)
+            results = {
+                "commit": git_commit(),
+                "config": {key: value for key, value in vars(args).items() if key not in ("command", "ollama_url", "searxng_url", "output")},
+                "startup_rss_mb": peak_rss_mb(server.pid),
+                "workloads": {},
+            }
+            connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+            timeout = aiohttp.ClientTimeout(total=args.timeout)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                client = LoadClient(base_url, session, random.Random(args.seed), args.distinct)
+                for name in args.workloads:
+                    result = await run_workload(client, name, args.requests, args.concurrency)
+                    result["peak_rss_mb"] = peak_rss_mb(server.pid)
+                    results["workloads"][name] = result
+            workers = [peak_rss_mb(pid) for pid in child_pids(server.pid)]
+            results["peak_rss_mb"] = peak_rss_mb(server.pid)
+            results["worker_peak_rss_mb"] = [rss for rss in workers if rss is not None]
+            results["upstream_requests"] = upstreams.requests
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            await upstreams.stop()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", nargs="?", choices=("run", "serve"), default="run")
+    parser.add_argument("--workloads", nargs="*", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--requests", type=int, default=100, help="Requests per workload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--distinct", type=int, default=1000, help="Distinct prompts/queries/texts to draw from")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before a request counts as failed")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ollama-nodes", type=int, default=1, help="Fake Ollama servers to spread requests across")
+    parser.add_argument("--ollama-latency", type=float, default=0.05)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--token-delay", type=float, default=0.005)
+    parser.add_argument("--embed-dim", type=int, default=768)
+    parser.add_argument("--results", type=int, default=5, help="Results per SearXNG query")
+    parser.add_argument("--page-paragraphs", type=int, default=20)
+    parser.add_argument("--web-latency", type=float, default=0.02)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    # Only used by the server subprocess
+    parser.add_argument("--ollama-url", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--searxng-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+        return
+    results = asyncio.run(bench(args))
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()